@@ -0,0 +1,166 @@
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import fakeglacier
+import libjokull
+import sha256tree
+
+def measure(name, fn, repeat, nbytes=None, ops=None):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    r = {"name": name, "repeat": repeat, "seconds": best, "median": sorted(times)[len(times) // 2]}
+    if nbytes is not None:
+        r["bytes"] = nbytes
+        r["mb_per_s"] = nbytes / best / 2**20
+    if ops is not None:
+        r["ops"] = ops
+        r["ops_per_s"] = ops / best
+    return r
+
+def bench_treehash_update(data, f, session, workers):
+    def run():
+        h = sha256tree.TreeHash()
+        h.update(data)
+        h.finish()
+    return run, len(data), None
+
+def bench_treehash_parallel(data, f, session, workers):
+    return lambda: sha256tree.treehash_parallel(f, workers=workers), len(data), None
+
+def bench_hash_stream(data, f, session, workers):
+    def run():
+        f.seek(0)
+        sha256tree.hash_stream(f)
+    return run, len(data), None
+
+def bench_sign(data, f, session, workers):
+    n = 10000
+    headers = [("Host", session.host), ("x-amz-date", "20120925T000000Z"), ("x-amz-glacier-version", "2012-06-01")]
+    payload_hash = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    def run():
+        for i in range(n):
+            session.signer.sign("GET", "/-/vaults/bench-vault/jobs", headers, "20120925T000000Z", query=[("limit", "10")], payload_hash=payload_hash)
+    return run, None, n
+
+def bench_upload_archive(data, f, session, workers):
+    return lambda: session.upload_archive("bench-vault", data), len(data), None
+
+def bench_upload_file(data, f, session, workers):
+    return lambda: session.upload_archive("bench-vault", f, workers=workers), len(data), None
+
+def bench_multipart(data, f, session, workers):
+    def run():
+        m = session.upload_multipart("bench-vault", workers=workers)
+        for i in range(0, len(data), 1048576):
+            m.write(data[i:i+1048576])
+        m.finish()
+    return run, len(data), None
+
+def bench_get(data, f, session, workers):
+    archive = session.upload_archive("bench-vault", data)["x-amz-archive-id"]
+    def run():
+        r = session.get("bench-vault", archive)
+        while r.read(1048576):
+            pass
+    return run, len(data), None
+
+Benchmarks = [
+    ("treehash_update", bench_treehash_update),
+    ("treehash_parallel", bench_treehash_parallel),
+    ("hash_stream", bench_hash_stream),
+    ("sign", bench_sign),
+    ("upload_archive", bench_upload_archive),
+    ("upload_file", bench_upload_file),
+    ("multipart", bench_multipart),
+    ("get", bench_get),
+]
+
+def run(size, repeat=3, workers=libjokull.DEFAULT_WORKERS, only=None):
+    data = os.urandom(size)
+    server = fakeglacier.serve(verify=False)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as d, tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            session = libjokull.Jokull(access="bench-access", secret="bench-secret", host=server.server_address[0], port=server.server_address[1], secure=False)
+            session.dir = d
+            session.create_vault("bench-vault")
+            for name, bench in Benchmarks:
+                if only and name not in only:
+                    continue
+                fn, nbytes, ops = bench(data, f, session, workers)
+                results.append(measure(name, fn, repeat, nbytes=nbytes, ops=ops))
+            session.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def compare(results, baseline):
+    old = {x["name"]: x for x in baseline["results"]}
+    for r in results:
+        b = old.get(r["name"])
+        if b is None:
+            continue
+        key = "mb_per_s" if "mb_per_s" in r else "ops_per_s"
+        if key in b:
+            r["baseline"] = b[key]
+            r["change"] = r[key] / b[key] - 1
+
+def main():
+    args = sys.argv[1:]
+    size = 64
+    repeat = 3
+    workers = libjokull.DEFAULT_WORKERS
+    only = None
+    output = None
+    baseline = None
+    while args:
+        a = args.pop(0)
+        if a == "-s":
+            size = int(args.pop(0))
+        elif a == "-n":
+            repeat = int(args.pop(0))
+        elif a == "-j":
+            workers = int(args.pop(0))
+        elif a == "--only":
+            only = args.pop(0).split(",")
+        elif a == "--output":
+            output = args.pop(0)
+        elif a == "--compare":
+            with open(args.pop(0)) as f:
+                baseline = json.load(f)
+        else:
+            print("Unknown option: {}".format(a))
+            sys.exit(1)
+    results = run(size * 1048576, repeat=repeat, workers=workers, only=only)
+    if baseline is not None:
+        compare(results, baseline)
+    doc = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "size": size * 1048576,
+        "workers": workers,
+        "results": results,
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(doc, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(doc, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import hashlib
+import http.server
+import json
+import threading
+
+import sha256tree
+
+class FakeGlacierHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    vaults = {}
+    uploads = {}
+    verify = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if data and self.verify:
+            assert self.headers["x-amz-content-sha256"] == hashlib.sha256(data).hexdigest()
+            assert self.headers["x-amz-sha256-tree-hash"] == sha256tree.treehash(data).hexdigest()
+        return data
+
+    def do_GET(self):
+        p = self.path.split("/")
+        if p[2:] == ["vaults"]:
+            self.reply(200, json.dumps({"Marker": None, "VaultList": [{"VaultName": x} for x in sorted(self.vaults)]}).encode())
+        elif p[3] not in self.vaults:
+            self.reply(404, json.dumps({"code": "ResourceNotFoundException", "message": self.path, "type": "Client"}).encode())
+        elif len(p) == 4:
+            self.reply(200, json.dumps({"VaultName": p[3], "NumberOfArchives": len(self.vaults[p[3]])}).encode())
+        elif p[4:] == ["jobs"] or len(p) == 6:
+            self.reply(200, json.dumps({"JobList": [], "Marker": None}).encode())
+        elif p[6:] == ["output"]:
+            data = self.vaults[p[3]][p[5]]
+            if "Range" in self.headers:
+                start, end = [int(x) for x in self.headers["Range"].split("=")[1].split("-")]
+                data = data[start:end+1]
+            headers = [("x-amz-sha256-tree-hash", sha256tree.treehash(data).hexdigest())] if self.verify else []
+            self.reply(200, data, headers)
+        else:
+            self.reply(404, json.dumps({"code": "ResourceNotFoundException", "message": self.path, "type": "Client"}).encode())
+
+    def do_PUT(self):
+        p = self.path.split("/")
+        data = self.body()
+        if len(p) == 4:
+            self.vaults.setdefault(p[3], {})
+            self.reply(201)
+        elif p[5] not in self.uploads:
+            self.reply(404, json.dumps({"code": "ResourceNotFoundException", "message": self.path, "type": "Client"}).encode())
+        else:
+            start = int(self.headers["Content-Range"].split()[1].split("-")[0])
+            self.uploads[p[5]][start] = data
+            self.reply(204, headers=[("x-amz-sha256-tree-hash", self.headers["x-amz-sha256-tree-hash"])])
+
+    def do_POST(self):
+        p = self.path.split("/")
+        data = self.body()
+        if p[4] == "multipart-uploads" and len(p) == 5:
+            upload_id = "upload-{}".format(len(self.uploads))
+            self.uploads[upload_id] = {}
+            self.reply(201, headers=[("x-amz-multipart-upload-id", upload_id)])
+            return
+        if p[4] == "multipart-uploads":
+            parts = self.uploads.pop(p[5])
+            data = b"".join(parts[x] for x in sorted(parts))
+            assert str(len(data)) == self.headers["x-amz-archive-size"]
+        tree_hash = self.headers["x-amz-sha256-tree-hash"]
+        if self.verify:
+            assert tree_hash == sha256tree.treehash(data).hexdigest()
+        archive_id = "archive-{}".format(sum(len(x) for x in self.vaults.values()))
+        self.vaults[p[3]][archive_id] = data
+        self.reply(201, headers=[("x-amz-archive-id", archive_id), ("x-amz-sha256-tree-hash", tree_hash)])
+
+    def do_DELETE(self):
+        p = self.path.split("/")
+        if len(p) == 6:
+            del self.vaults[p[3]][p[5]]
+        else:
+            del self.vaults[p[3]]
+        self.reply(204)
+
+def serve(host="127.0.0.1", port=0, verify=True):
+    FakeGlacierHandler.vaults = {}
+    FakeGlacierHandler.uploads = {}
+    FakeGlacierHandler.verify = verify
+    server = http.server.ThreadingHTTPServer((host, port), FakeGlacierHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
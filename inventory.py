@@ -0,0 +1,224 @@
+import codecs
+import csv
+import fnmatch
+import json
+import re
+import sqlite3
+import time
+
+import oplog
+
+class InventoryReader:
+    def __init__(self, f, since=None, until=None, description=None, chunksize=65536):
+        self.f = f
+        self.since = since
+        self.until = until
+        self.description = description
+        self.chunksize = chunksize
+        self.decoder = codecs.getincrementaldecoder("UTF-8")()
+        self.buf = ""
+        self.vault_arn = None
+        self.inventory_date = None
+
+    def fill(self):
+        data = self.f.read(self.chunksize)
+        self.buf += self.decoder.decode(data, final=not data)
+        return bool(data)
+
+    def __iter__(self):
+        while not self.buf.strip() and self.fill():
+            pass
+        if self.buf.lstrip("\ufeff \t\r\n").startswith("{"):
+            entries = self.iter_json()
+        else:
+            entries = self.iter_csv()
+        for a in entries:
+            if self.since is not None and a["CreationDate"] < self.since:
+                continue
+            if self.until is not None and a["CreationDate"] >= self.until:
+                continue
+            if self.description is not None and not fnmatch.fnmatchcase(a["ArchiveDescription"], self.description):
+                continue
+            yield a
+
+    def scan_header(self, text):
+        m = re.search(r'"VaultARN"\s*:\s*"([^"]*)"', text)
+        if m:
+            self.vault_arn = m.group(1)
+        m = re.search(r'"InventoryDate"\s*:\s*"([^"]*)"', text)
+        if m:
+            self.inventory_date = m.group(1)
+
+    def iter_json(self):
+        decoder = json.JSONDecoder()
+        while True:
+            m = re.search(r'"ArchiveList"\s*:\s*\[', self.buf)
+            if m:
+                break
+            if not self.fill():
+                raise ValueError("inventory has no ArchiveList")
+        self.scan_header(self.buf[:m.start()])
+        self.buf = self.buf[m.end():]
+        pos = 0
+        while True:
+            while True:
+                while pos < len(self.buf) and self.buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(self.buf) or not self.fill():
+                    break
+            if pos >= len(self.buf):
+                raise ValueError("inventory ArchiveList is truncated")
+            if self.buf[pos] == "]":
+                break
+            try:
+                a, end = decoder.raw_decode(self.buf, pos)
+            except ValueError:
+                self.buf = self.buf[pos:]
+                pos = 0
+                if not self.fill():
+                    raise
+                continue
+            yield a
+            pos = end
+            if pos > self.chunksize:
+                self.buf = self.buf[pos:]
+                pos = 0
+        self.buf = self.buf[pos + 1:]
+        while self.fill():
+            pass
+        self.scan_header(self.buf)
+
+    def iter_lines(self):
+        while True:
+            more = self.fill()
+            lines = self.buf.split("\n")
+            self.buf = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            if not more:
+                if self.buf:
+                    yield self.buf
+                    self.buf = ""
+                return
+
+    def iter_csv(self):
+        reader = csv.reader(self.iter_lines())
+        header = [x.lstrip("\ufeff") for x in next(reader)]
+        for row in reader:
+            if not row:
+                continue
+            a = dict(zip(header, row))
+            a["Size"] = int(a["Size"])
+            yield a
+
+class Inventory:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            create table if not exists archives (
+                archive_id text primary key,
+                vault text not null,
+                description text,
+                creation_date text,
+                size integer,
+                tree_hash text,
+                deleted integer not null default 0
+            );
+            create index if not exists archives_vault on archives (vault);
+            create index if not exists archives_description on archives (description);
+            create index if not exists archives_tree_hash on archives (tree_hash);
+            create table if not exists meta (
+                key text primary key,
+                value text
+            );
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("select value from meta where key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        self.db.execute("insert or replace into meta (key, value) values (?, ?)", (key, str(value)))
+
+    def add(self, vault, archive_id, description, creation_date, size, tree_hash):
+        self.db.execute("""
+            insert into archives (archive_id, vault, description, creation_date, size, tree_hash, deleted)
+            values (?, ?, ?, ?, ?, ?, 0)
+            on conflict (archive_id) do update set
+                vault = excluded.vault,
+                description = coalesce(excluded.description, description),
+                creation_date = coalesce(excluded.creation_date, creation_date),
+                size = coalesce(excluded.size, size),
+                tree_hash = coalesce(excluded.tree_hash, tree_hash),
+                deleted = 0
+        """, (archive_id, vault, description, creation_date, size, tree_hash))
+
+    def delete(self, vault, archive_id=None):
+        if archive_id is None:
+            self.db.execute("update archives set deleted = 1 where vault = ?", (vault,))
+        else:
+            self.db.execute("update archives set deleted = 1 where vault = ? and archive_id = ?", (vault, archive_id))
+
+    def load_inventory(self, vault, f):
+        reader = InventoryReader(f)
+        with self.db:
+            self.db.execute("create temp table if not exists seen (archive_id text primary key)")
+            self.db.execute("delete from seen")
+            for a in reader:
+                self.add(vault, a["ArchiveId"], a["ArchiveDescription"], a["CreationDate"], a["Size"], a["SHA256TreeHash"])
+                self.db.execute("insert or ignore into seen (archive_id) values (?)", (a["ArchiveId"],))
+            if reader.inventory_date is not None:
+                self.db.execute("""
+                    update archives set deleted = 1
+                    where vault = ? and deleted = 0 and creation_date < ?
+                    and archive_id not in (select archive_id from seen)
+                """, (vault, reader.inventory_date))
+            self.db.execute("delete from seen")
+
+    def sync_log(self, path):
+        segment = int(self.get_meta("log_segment", 1))
+        offset = int(self.get_meta("log_offset", 0))
+        with self.db:
+            for segment, offset, row in oplog.LogReader(path).read_from(segment, offset):
+                self.apply(row)
+            self.set_meta("log_segment", segment)
+            self.set_meta("log_offset", offset)
+
+    def apply(self, row):
+        if row[1] == "upload_archive":
+            self.add(row[2], row[4], row[3] or None, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(float(row[0]))), None, row[5])
+        elif row[1] == "delete_archive":
+            self.delete(row[2], row[3])
+        elif row[1] == "delete_vault":
+            self.delete(row[2])
+
+    def find(self, vault=None, archive_id=None, description=None, tree_hash=None, pattern=None, deleted=False):
+        where = []
+        args = []
+        if vault is not None:
+            where.append("vault = ?")
+            args.append(vault)
+        if archive_id is not None:
+            where.append("archive_id = ?")
+            args.append(archive_id)
+        if description is not None:
+            where.append("description glob ?")
+            args.append(description)
+        if tree_hash is not None:
+            where.append("tree_hash = ?")
+            args.append(tree_hash)
+        if pattern is not None:
+            where.append("(description glob ? or archive_id = ? or tree_hash = ?)")
+            args.extend([pattern, pattern, pattern])
+        if not deleted:
+            where.append("deleted = 0")
+        sql = "select * from archives"
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by vault, creation_date"
+        return [dict(x) for x in self.db.execute(sql, args)]
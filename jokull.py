@@ -1,8 +1,146 @@
+import calendar
+import concurrent.futures
+import csv
+import io
+import json
+import os
 import pprint
-import shutil
+import shlex
 import sys
+import threading
+import time
 
+import inventory
 import libjokull
+import oplog
+
+def option(args, name):
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+def option_value(args, name, default=None):
+    if name not in args:
+        return default
+    i = args.index(name)
+    value = args[i+1]
+    del args[i:i+2]
+    return value
+
+def option_flag(args, name, default):
+    for i, x in enumerate(args):
+        if x == name:
+            del args[i]
+            return default
+        if x.startswith(name + "="):
+            del args[i]
+            return x[len(name)+1:]
+    return None
+
+def parse_size(s):
+    units = {"K": 1, "M": 2, "G": 3, "T": 4}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * 1024 ** units[s[-1:].upper()])
+    return int(s)
+
+def print_stats(out, metrics, format="table"):
+    summary = metrics.summary()
+    if format == "json":
+        json.dump(summary, out, indent=2, sort_keys=True)
+        print(file=out)
+        return
+    phases = ["hash", "sign", "queue", "connect", "send", "wait", "receive", "backoff"]
+    print("{:<24} {:>6} {:>6} {:>7} {:>12} {:>12} {:>9}".format("operation", "count", "errors", "retries", "sent", "received", "seconds") + "".join(" {:>8}".format(x) for x in phases), file=out)
+    rows = sorted(summary["operations"].items()) + [("total", summary["total"])]
+    for name, op in rows:
+        print("{:<24} {:>6} {:>6} {:>7} {:>12} {:>12} {:>9.3f}".format(name, op["count"], op["errors"], op["retries"], op["sent"], op["received"], op["seconds"]) + "".join(" {:>8.3f}".format(op["phases"].get(x, 0)) for x in phases), file=out)
+
+def print_archive(out, a):
+    print("{}\t{}\t{}\t{}\t{}\t{}".format(a["vault"], a["creation_date"], a["size"] if a["size"] is not None else "-", a["archive_id"], a["tree_hash"], a["description"] or ""), file=out)
+
+def parse_batch_line(line):
+    line = line.strip()
+    if line.startswith("{"):
+        command = json.loads(line)
+        return command.get("id"), command["args"]
+    if line.startswith("["):
+        return None, json.loads(line)
+    return None, shlex.split(line)
+
+def reads_stdin(args):
+    args = list(args)
+    for name in ["--size", "--part-size", "--buffer", "--workers", "--checkpoint", "--interval", "--download"]:
+        option_value(args, name)
+    args = [x for x in args if not x.startswith("--")]
+    return args[1] == "batch" or args[1] == "upload" and len(args) < 4 or args[1] == "delete-many" and args[3:4] == ["-"]
+
+def run_batch_command(session, n, id, command):
+    result = {"line": n, "command": command}
+    if id is not None:
+        result["id"] = id
+    try:
+        args = ["jokull"] + command
+        fn = Commands.get(args[1]) if len(args) > 1 else None
+        if fn is None:
+            raise ValueError("Unknown command: {}".format(args[1] if len(args) > 1 else ""))
+        if reads_stdin(args):
+            raise ValueError("Command cannot read stdin in a batch: {}".format(args[1]))
+        o = io.StringIO()
+        fn(o, session, args)
+        result["ok"] = True
+        result["output"] = o.getvalue()
+    except Exception as x:
+        result["ok"] = False
+        result["error"] = str(x)
+    return result
+
+def do_batch(out, session, args):
+    workers = int(option_value(args, "--workers", libjokull.DEFAULT_BATCH_WORKERS))
+    session.pool.size = max(session.pool.size, workers)
+    commands = sys.stdin if len(args) < 3 or args[2] == "-" else open(args[2])
+    lock = threading.Lock()
+    def emit(result):
+        with lock:
+            print(json.dumps(result), file=out, flush=True)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as e:
+            pending = set()
+            tails = {}
+            def schedule(n, id, command):
+                f = concurrent.futures.Future()
+                def start(_=None):
+                    e.submit(run_batch_command, session, n, id, command).add_done_callback(lambda r: f.set_result(r.result()))
+                vault = command[1] if len(command) > 1 else None
+                prev = tails.get(vault)
+                if vault is not None:
+                    tails[vault] = f
+                if prev is not None:
+                    prev.add_done_callback(start)
+                else:
+                    start()
+                return f
+            for n, line in enumerate(commands, 1):
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                if line.strip() == "wait":
+                    concurrent.futures.wait(pending)
+                    pending = set()
+                    continue
+                try:
+                    id, command = parse_batch_line(line)
+                except (ValueError, KeyError) as x:
+                    emit({"line": n, "ok": False, "error": str(x)})
+                    continue
+                if len(pending) >= 2 * workers:
+                    _, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                f = schedule(n, id, command)
+                f.add_done_callback(lambda f: emit(f.result()))
+                pending.add(f)
+            concurrent.futures.wait(pending)
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
 
 def do_create(out, session, args):
     session.create_vault(args[2])
@@ -13,18 +151,87 @@ def do_delete(out, session, args):
     else:
         session.delete_vault(args[2])
 
+def do_delete_many(out, session, args):
+    workers = int(option_value(args, "--workers", libjokull.DEFAULT_DELETE_WORKERS))
+    checkpoint = option_value(args, "--checkpoint")
+    archives = sys.stdin if args[3] == "-" else open(args[3])
+    deleted = skipped = failed = 0
+    try:
+        for archive, ok, error in session.delete_archives(args[2], archives, workers=workers, checkpoint=checkpoint):
+            if error is not None:
+                failed += 1
+                print("error\t{}\t{}".format(archive, error), file=out)
+            elif ok:
+                deleted += 1
+            else:
+                skipped += 1
+    finally:
+        if archives is not sys.stdin:
+            archives.close()
+    print("{} deleted, {} skipped, {} failed".format(deleted, skipped, failed), file=out)
+
 def do_describe(out, session, args):
     vault = session.describe_vault(args[2])
     pprint.pprint(vault, stream=out)
 
+def do_find(out, session, args):
+    inv = session.inventory()
+    for a in inv.find(vault=args[3] if len(args) >= 4 else None, pattern=args[2]):
+        print_archive(out, a)
+
 def do_get(out, session, args):
+    session.download(args[2], args[3], args[4])
+
+def do_import(out, session, args):
+    job = option_value(args, "--job")
+    inv = session.inventory()
+    f = session.get(args[2], job) if job is not None else open(args[3], "rb")
+    try:
+        inv.load_inventory(args[2], f)
+    finally:
+        f.close()
+
+def do_inventory(out, session, args):
+    since = option_value(args, "--since")
+    until = option_value(args, "--until")
+    description = option_value(args, "--description")
     f = session.get(args[2], args[3])
-    with open(args[4], "wb") as outf:
-        shutil.copyfileobj(f, outf)
+    try:
+        for a in inventory.InventoryReader(f, since=since, until=until, description=description):
+            print("{}\t{}\t{}\t{}\t{}".format(a["CreationDate"], a["Size"], a["ArchiveId"], a["SHA256TreeHash"], a["ArchiveDescription"]), file=out)
+    finally:
+        f.close()
 
 def do_jobs(out, session, args):
-    jobs = session.list_jobs(args[2])
-    pprint.pprint(jobs, stream=out)
+    for job in session.iter_jobs(args[2], prefetch=True):
+        pprint.pprint(job, stream=out)
+
+def parse_time(s):
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    for fmt in ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]:
+        try:
+            return calendar.timegm(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Unknown time format: {}".format(s))
+
+def do_log(out, session, args):
+    since = option_value(args, "--since")
+    until = option_value(args, "--until")
+    vault = option_value(args, "--vault")
+    if session.oplog is not None:
+        session.oplog.flush()
+    writer = csv.writer(out, lineterminator="\n")
+    for row in oplog.LogReader(os.path.join(session.dir, "log")).read(since=parse_time(since) if since else None, until=parse_time(until) if until else None, vault=vault):
+        writer.writerow(row)
+
+def do_ls(out, session, args):
+    inv = session.inventory()
+    for a in inv.find(vault=args[2]):
+        print_archive(out, a)
 
 def do_request(out, session, args):
     if len(args) >= 4:
@@ -34,42 +241,96 @@ def do_request(out, session, args):
     print(r, file=out)
 
 def do_upload(out, session, args):
+    resume = option(args, "--resume")
+    dedup = option(args, "--dedup")
+    size = option_value(args, "--size")
+    partsize = option_value(args, "--part-size")
+    workers = int(option_value(args, "--workers", libjokull.DEFAULT_WORKERS))
+    buffer = option_value(args, "--buffer")
     if len(args) >= 4:
         with open(args[3], "rb") as f:
-            r = session.upload_archive(args[2], f, filename=args[3])
+            r = session.upload_archive(args[2], f, filename=args[3], workers=workers, resume=resume, dedup=dedup)
             print(r, file=out)
     else:
-        m = session.upload_multipart(args[2])
-        while True:
-            s = sys.stdin.read(65536)
-            if not s:
-                break
-            m.write(s)
-        r = m.finish()
+        r = session.upload_stream(args[2], sys.stdin.buffer, size=parse_size(size) if size else None, partsize=parse_size(partsize) if partsize else None, workers=workers, budget=parse_size(buffer) if buffer else libjokull.DEFAULT_BUFFER_BUDGET)
         print(r, file=out)
 
+def do_upload_tree(out, session, args):
+    workers = int(option_value(args, "--workers", libjokull.DEFAULT_WORKERS))
+    max_requests = option_value(args, "--max-requests")
+    max_rate = option_value(args, "--max-rate")
+    dedup = option(args, "--dedup")
+    session.set_limits(max_requests=int(max_requests) if max_requests else None, max_rate=int(max_rate) if max_rate else None)
+    uploaded = failed = total = 0
+    for path, size, r, error in session.upload_tree(args[2], args[3], workers=workers, dedup=dedup):
+        if error is not None:
+            failed += 1
+            print("error\t{}\t{}".format(path, error), file=out)
+        else:
+            uploaded += 1
+            total += size
+            print("ok\t{}\t{}".format(path, r["x-amz-archive-id"]), file=out)
+    print("{} uploaded, {} failed, {} bytes".format(uploaded, failed, total), file=out)
+
+def do_watch(out, session, args):
+    directory = option_value(args, "--download")
+    interval = float(option_value(args, "--interval", libjokull.DEFAULT_POLL_INTERVAL))
+    if directory is not None:
+        for job, filename, error in session.download_jobs(args[2], args[3:], directory, interval=interval):
+            if error is not None:
+                print("{}\terror\t{}".format(job["JobId"], error), file=out, flush=True)
+            elif filename is not None:
+                print("{}\t{}\t{}".format(job["JobId"], job["StatusCode"], filename), file=out, flush=True)
+            else:
+                print("{}\t{}\t{}".format(job["JobId"], job["StatusCode"], job.get("StatusMessage", "")), file=out, flush=True)
+    else:
+        for job in session.watch_jobs(args[2], args[3:], interval=interval):
+            print("{}\t{}\t{}".format(job["JobId"], job["StatusCode"], job.get("StatusMessage", "")), file=out, flush=True)
+
 def do_vaults(out, session, args):
-    vaults = session.list_vaults()
-    pprint.pprint(vaults, stream=out)
+    for vault in session.iter_vaults(prefetch=True):
+        pprint.pprint(vault, stream=out)
 
 Commands = {
+    "batch": do_batch,
     "create": do_create,
     "delete": do_delete,
+    "delete-many": do_delete_many,
     "describe": do_describe,
+    "find": do_find,
     "get": do_get,
+    "import": do_import,
+    "inventory": do_inventory,
     "jobs": do_jobs,
+    "log": do_log,
+    "ls": do_ls,
     "request": do_request,
     "upload": do_upload,
+    "upload-tree": do_upload_tree,
     "vaults": do_vaults,
+    "watch": do_watch,
 }
 
 def main():
-    fn = Commands.get(sys.argv[1])
+    args = list(sys.argv)
+    stats = option_flag(args, "--stats", "table")
+    no_cache = option(args, "--no-cache")
+    if stats not in (None, "json", "table"):
+        print("Unknown stats format: {}".format(stats))
+        sys.exit(1)
+    fn = Commands.get(args[1])
     if fn is None:
-        print("Unknown command: {}".format(sys.argv[1]))
+        print("Unknown command: {}".format(args[1]))
         sys.exit(1)
     session = libjokull.Jokull()
-    fn(sys.stdout, session, sys.argv)
+    if not no_cache:
+        session.hash_cache_path = os.path.join(session.dir, "treehash.db")
+    try:
+        fn(sys.stdout, session, args)
+    finally:
+        session.close()
+        if stats is not None:
+            print_stats(sys.stderr, session.metrics, stats)
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,74 @@
+import asyncio
+import collections
+import concurrent.futures
 import csv
+import email.parser
 import hashlib
 import hmac
+import http.client
+import io
 import json
-import itertools
+import mmap
 import os
+import queue
+import random
+import shutil
+import stat
+import threading
 import time
 import urllib.parse
-import urllib.request
 
+import inventory
+import oplog
 import sha256tree
 
+DEFAULT_HOST = "glacier.us-east-1.amazonaws.com"
+DEFAULT_WORKERS = 4
+DEFAULT_POOL_SIZE = 8
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_TIMEOUT = 120
+DEFAULT_CHUNK_SIZE = 32*1048576
+DEFAULT_CONCURRENCY = 64
+DEFAULT_DELETE_WORKERS = 16
+DEFAULT_BATCH_WORKERS = 8
+DEFAULT_LOG_DURABILITY = "periodic"
+DEFAULT_PART_SIZE = 4*1048576
+DEFAULT_STREAM_PART_SIZE = 32*1048576
+DEFAULT_READAHEAD = 2
+DEFAULT_BUFFER_BUDGET = 512*1048576
+MAX_PART_SIZE = 4096*1048576
+MAX_PARTS = 10000
+MAX_BACKOFF = 30
+
+DEFAULT_RETRIES = 5
+DEFAULT_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 900
+RETRY_BASE = 0.5
+
+THROTTLING_CODES = {"ThrottlingException", "RequestLimitExceeded", "SlowDown"}
+RETRYABLE_CODES = THROTTLING_CODES | {"RequestTimeoutException", "ServiceUnavailableException", "InternalFailure", "InternalError"}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+LOG_LOCK = threading.Lock()
+
+OPERATIONS = {
+    ("GET", "vaults"): "ListVaults",
+    ("PUT", "vaults/*"): "CreateVault",
+    ("GET", "vaults/*"): "DescribeVault",
+    ("DELETE", "vaults/*"): "DeleteVault",
+    ("POST", "vaults/*/archives"): "UploadArchive",
+    ("DELETE", "vaults/*/archives/*"): "DeleteArchive",
+    ("POST", "vaults/*/jobs"): "InitiateJob",
+    ("GET", "vaults/*/jobs"): "ListJobs",
+    ("GET", "vaults/*/jobs/*"): "DescribeJob",
+    ("GET", "vaults/*/jobs/*/output"): "GetJobOutput",
+    ("POST", "vaults/*/multipart-uploads"): "InitiateMultipartUpload",
+    ("GET", "vaults/*/multipart-uploads"): "ListMultipartUploads",
+    ("PUT", "vaults/*/multipart-uploads/*"): "UploadMultipartPart",
+    ("POST", "vaults/*/multipart-uploads/*"): "CompleteMultipartUpload",
+    ("DELETE", "vaults/*/multipart-uploads/*"): "AbortMultipartUpload",
+    ("GET", "vaults/*/multipart-uploads/*"): "ListParts",
+}
+
 class GlacierError(Exception):
     def __init__(self, httpcode, code, message, type):
         Exception.__init__(self, httpcode, code, message, type)
@@ -20,16 +79,32 @@ class GlacierError(Exception):
     def __str__(self):
         return """GlacierError(httpcode={} code={} message="{}" type={})""".format(self.httpcode, self.code, self.message, self.type)
 
-def make_canonical_request(method, uri, headers, query=None, data=None):
-    sorted_headers = sorted((k.lower(), v) for k, v in headers)
-    signed_headers = ";".join(k for k, g in itertools.groupby(sorted_headers, lambda x: x[0]))
+class ResumeError(Exception):
+    pass
+
+class DownloadError(Exception):
+    pass
+
+def make_query_string(query):
+    return "&".join("{}={}".format(urllib.parse.quote(k, safe="~"), urllib.parse.quote(v, safe="~")) for k, v in sorted(query))
+
+def make_canonical_request(method, uri, headers, query=None, data=None, payload_hash=None):
+    names = []
+    lines = []
+    for k, v in sorted((k.lower(), v) for k, v in headers):
+        if names and names[-1] == k:
+            lines[-1] += "," + v
+        else:
+            names.append(k)
+            lines.append(k + ":" + v)
+    signed_headers = ";".join(names)
     return (
         method + "\n" +
         uri + "\n" +
-        ("&".join("{}={}".format(urllib.parse.quote(k, safe="~"), urllib.parse.quote(v, safe="~")) for k, v in sorted(query)) if query else "") + "\n" +
-        "".join("{}:{}\n".format(k, ",".join(x[1] for x in g)) for k, g in itertools.groupby(sorted_headers, lambda x: x[0])) + "\n" +
+        (make_query_string(query) if query else "") + "\n" +
+        "".join(x + "\n" for x in lines) + "\n" +
         signed_headers + "\n" +
-        hashlib.sha256(data if data is not None else b"").hexdigest()
+        (payload_hash if payload_hash is not None else hashlib.sha256(data if data is not None else b"").hexdigest())
     ), signed_headers
 
 def make_string_to_sign(datetime, date, region, service, canonical_request):
@@ -40,80 +115,667 @@ def make_string_to_sign(datetime, date, region, service, canonical_request):
         hashlib.sha256(canonical_request.encode("UTF-8")).hexdigest()
     )
 
-def make_authorization_header(access, secret, date, region, service, signed_headers, string_to_sign):
-    signing_key = hmac.new(hmac.new(hmac.new(hmac.new(("AWS4" + secret).encode("UTF-8"), date.encode("UTF-8"), digestmod=hashlib.sha256).digest(), region.encode("UTF-8"), digestmod=hashlib.sha256).digest(), service.encode("UTF-8"), digestmod=hashlib.sha256).digest(), b"aws4_request", digestmod=hashlib.sha256).digest()
+def make_signing_key(secret, date, region, service):
+    key = ("AWS4" + secret).encode("UTF-8")
+    for x in [date, region, service, "aws4_request"]:
+        key = hmac.new(key, x.encode("UTF-8"), digestmod=hashlib.sha256).digest()
+    return key
+
+def make_authorization_header(access, secret, date, region, service, signed_headers, string_to_sign, signing_key=None):
+    if signing_key is None:
+        signing_key = make_signing_key(secret, date, region, service)
     signature = hmac.new(signing_key, string_to_sign.encode("UTF-8"), digestmod=hashlib.sha256).hexdigest()
     return "AWS4-HMAC-SHA256 Credential={}/{}/{}/{}/aws4_request, SignedHeaders={}, Signature={}".format(access, date, region, service, signed_headers, signature)
 
+def make_headers(signer, host, method, uri, headers=None, data=None, hashes=None, query=None):
+    datetime = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(time.time()))
+    if headers is None:
+        headers = []
+    headers[:0] = [
+        ("Host", host),
+        ("Date", datetime),
+        ("x-amz-glacier-version", "2012-06-01"),
+    ]
+    payload_hash = None
+    if data is not None:
+        if hashes is None:
+            hashes = sha256tree.treehash_sha256(data)
+        payload_hash = hashes[0].hexdigest()
+        headers.append(("Content-Length", str(len(data))))
+        headers.append(("x-amz-content-sha256", payload_hash))
+        headers.append(("x-amz-sha256-tree-hash", hashes[1].hexdigest()))
+    headers.append(("Authorization", signer.sign(method, uri, headers, datetime, query=query, data=data, payload_hash=payload_hash)))
+    return headers
+
+def part_size(size, minimum=DEFAULT_PART_SIZE):
+    partsize = minimum
+    while partsize * MAX_PARTS < size:
+        partsize *= 2
+    if partsize > MAX_PART_SIZE:
+        raise ValueError("archive of {} bytes is too large for a multipart upload".format(size))
+    return partsize
+
+def chunk_size(size):
+    blocks = max(1, size // sha256tree.TreeHash.BLOCK_SIZE)
+    return sha256tree.TreeHash.BLOCK_SIZE << (blocks.bit_length() - 1)
+
+def operation_name(method, uri):
+    p = uri.split("?", 1)[0].split("/")[2:]
+    shape = "/".join("*" if i % 2 else x for i, x in enumerate(p))
+    return OPERATIONS.get((method, shape), "{} /{}".format(method, shape))
+
+def make_list_query(marker=None, limit=None, completed=None):
+    query = []
+    if completed is not None:
+        query.append(("completed", "true" if completed else "false"))
+    if marker is not None:
+        query.append(("marker", marker))
+    if limit is not None:
+        query.append(("limit", str(limit)))
+    return query
+
+def read_credentials():
+    access = secret = None
+    with open(os.path.join(os.getenv("HOME"), ".s3crc")) as f:
+        for s in f:
+            a = s.split()
+            if a[0] == "access":
+                access = a[1]
+            if a[0] == "secret":
+                secret = a[1]
+    return access, secret
+
+class Signer:
+    def __init__(self, access, secret, region, service):
+        self.access = access
+        self.secret = secret
+        self.region = region
+        self.service = service
+        self.key = (None, None)
+
+    def signing_key(self, date):
+        key = self.key
+        if key[0] != date:
+            key = (date, make_signing_key(self.secret, date, self.region, self.service))
+            self.key = key
+        return key[1]
+
+    def sign(self, method, uri, headers, datetime, query=None, data=None, payload_hash=None):
+        date = datetime[:8]
+        canonical_request, signed_headers = make_canonical_request(method, uri, headers, query=query, data=data, payload_hash=payload_hash)
+        string_to_sign = make_string_to_sign(datetime, date, self.region, self.service, canonical_request)
+        return make_authorization_header(self.access, self.secret, date, self.region, self.service, signed_headers, string_to_sign, signing_key=self.signing_key(date))
+
+class ConnectionPool:
+    def __init__(self, host, size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, port=None, secure=True, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def get(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, last = self.idle.pop()
+                if now - last < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self.connect(), False
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, last in idle:
+            conn.close()
+
+class Response:
+    def __init__(self, pool, conn, response, stream=False, trace=None, metrics=None):
+        self.code = response.status
+        self.headers = response.headers
+        self.trace = trace
+        self.metrics = metrics
+        if stream:
+            self.pool = pool
+            self.conn = conn
+            self.fp = response
+        else:
+            self.pool = None
+            self.conn = None
+            body = response.read()
+            self.fp = io.BytesIO(body)
+            release(pool, conn, response)
+            if trace is not None:
+                trace.received += len(body)
+                trace.phase("receive")
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        data = self.fp.read(amt)
+        if self.conn is not None:
+            if self.trace is not None:
+                self.trace.received += len(data)
+            if self.fp.isclosed():
+                release(self.pool, self.conn, self.fp)
+                self.conn = None
+                self.done()
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.done()
+
+    def done(self):
+        if self.trace is not None:
+            self.trace.phase("receive")
+            if self.metrics is not None:
+                self.metrics.record(self.trace)
+            self.trace = None
+
+class Trace:
+    def __init__(self, method, uri):
+        self.method = method
+        self.uri = uri
+        self.operation = operation_name(method, uri)
+        self.phases = {}
+        self.sent = 0
+        self.received = 0
+        self.status = None
+        self.error = None
+        self.retries = 0
+        self.start = self.mark = time.perf_counter()
+        self.elapsed = None
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self.mark
+        self.mark = now
+
+class Metrics:
+    def __init__(self, keep=0):
+        self.operations = {}
+        self.traces = collections.deque(maxlen=keep)
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, trace):
+        trace.elapsed = time.perf_counter() - trace.start
+        with self.lock:
+            op = self.operations.get(trace.operation)
+            if op is None:
+                op = self.operations[trace.operation] = {"count": 0, "errors": 0, "retries": 0, "sent": 0, "received": 0, "seconds": 0, "phases": {}, "status": {}}
+            op["count"] += 1
+            op["errors"] += trace.error is not None
+            op["retries"] += trace.retries
+            op["sent"] += trace.sent
+            op["received"] += trace.received
+            op["seconds"] += trace.elapsed
+            for k, v in trace.phases.items():
+                op["phases"][k] = op["phases"].get(k, 0) + v
+            if trace.status is not None:
+                op["status"][str(trace.status)] = op["status"].get(str(trace.status), 0) + 1
+            self.traces.append(trace)
+        for hook in self.hooks:
+            hook(trace)
+
+    def summary(self):
+        with self.lock:
+            operations = {k: dict(v, phases=dict(v["phases"]), status=dict(v["status"])) for k, v in self.operations.items()}
+        total = {"count": 0, "errors": 0, "retries": 0, "sent": 0, "received": 0, "seconds": 0, "phases": {}}
+        for op in operations.values():
+            for k in ("count", "errors", "retries", "sent", "received", "seconds"):
+                total[k] += op[k]
+            for k, v in op["phases"].items():
+                total["phases"][k] = total["phases"].get(k, 0) + v
+        return {"operations": operations, "total": total}
+
+def release(pool, conn, response):
+    if response.will_close:
+        conn.close()
+    else:
+        pool.put(conn)
+
+class Throttle:
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= n
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class AdaptiveLimit:
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.delay = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, throttled):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.delay = min(MAX_BACKOFF, self.delay * 2 or 0.1)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+                self.delay = self.delay / 2 if self.delay > 0.1 else 0
+            self.cond.notify_all()
+            return self.delay
+
+def make_error(httpcode, body):
+    try:
+        e = json.loads(body)
+        return GlacierError(httpcode, e["code"], e["message"], e["type"])
+    except (ValueError, KeyError, TypeError):
+        return GlacierError(httpcode, http.client.responses.get(httpcode, str(httpcode)), body, "Server" if httpcode >= 500 else "Client")
+
+def retryable(x, idempotent=True):
+    if isinstance(x, GlacierError):
+        return x.code in RETRYABLE_CODES or idempotent and x.httpcode >= 500
+    if not idempotent and getattr(x, "sent", True):
+        return False
+    return isinstance(x, (ConnectionError, TimeoutError, http.client.HTTPException))
+
+def map_file(f, size):
+    if size == 0:
+        return None
+    try:
+        fileno = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    try:
+        return memoryview(mmap.mmap(fileno, size, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.kind = None
+        self.vault = None
+        self.id = None
+        self.partsize = None
+        self.filename = None
+        self.size = None
+        self.parts = {}
+        self.lock = threading.Lock()
+        self.f = None
+        if os.path.exists(path):
+            with open(path, newline="") as f:
+                for row in csv.reader(f):
+                    if row[0] == "part":
+                        self.parts[int(row[1])] = (int(row[2]), row[3])
+                    else:
+                        self.kind, self.vault, self.id, self.filename = row[0], row[1], row[2], row[4]
+                        self.partsize, self.size = int(row[3]), int(row[5])
+
+    def start(self, kind, vault, id, partsize, filename, size):
+        self.kind = kind
+        self.vault = vault
+        self.id = id
+        self.partsize = partsize
+        self.filename = filename
+        self.size = size
+        self.parts = {}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.f is not None:
+            self.f.close()
+        self.f = open(self.path, "w", newline="")
+        self.write((kind, vault, id, partsize, filename, size))
+
+    def add(self, offset, length, tree_hash):
+        with self.lock:
+            self.parts[offset] = (length, tree_hash)
+            self.write(("part", offset, length, tree_hash))
+
+    def write(self, row):
+        if self.f is None:
+            self.f = open(self.path, "a", newline="")
+        csv.writer(self.f, lineterminator="\n").writerow(row)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def remove(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 class Multipart:
-    def __init__(self, session, vault, partsize, upload_id):
+    def __init__(self, session, vault, partsize, upload_id, workers=1, journal=None, budget=DEFAULT_BUFFER_BUDGET):
         self.session = session
         self.vault = vault
         self.partsize = partsize
         self.upload_id = upload_id
-        self.hash = sha256tree.TreeHash()
+        self.journal = journal
+        self.leaves = None
+        self.hashes = {}
         self.offset = 0
-        self.part = b""
+        self.buffer = None
+        self.fill = 0
+        self.free = []
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers) if workers > 1 else None
+        self.pending = set()
+        self.workers = workers
+        self.budget = budget
+        self.plan()
+
+    def plan(self, readahead=0):
+        fixed = readahead + 2 if readahead else 1
+        self.maxpending = max(self.workers, min(2 * self.workers, self.budget // self.partsize - fixed))
+        self.maxbuffers = self.maxpending + fixed
+
+    def get_buffer(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.partsize)
+
+    def put_buffer(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
 
     def write(self, data):
-        index = 0
-        while index < len(data):
-            needed = self.partsize - len(self.part)
-            self.part += data[index:index + needed]
-            index += needed
-            if len(self.part) < self.partsize:
-                break
-            self.upload_part()
+        view = memoryview(data).cast("B")
+        while view:
+            if self.buffer is None:
+                self.buffer = self.get_buffer()
+            n = min(len(view), self.partsize - self.fill)
+            self.buffer[self.fill:self.fill + n] = view[:n]
+            self.fill += n
+            view = view[n:]
+            if self.fill == self.partsize:
+                self.upload_part()
+
+    def write_from(self, f, readahead=0):
+        self.plan(readahead)
+        try:
+            if readahead > 0:
+                self.write_ahead(f, readahead)
+                return
+            while True:
+                if self.buffer is None:
+                    self.buffer = self.get_buffer()
+                n = f.readinto(memoryview(self.buffer)[self.fill:])
+                if not n:
+                    break
+                self.fill += n
+                if self.fill == self.partsize:
+                    self.upload_part()
+        except BaseException:
+            self.shutdown()
+            raise
+
+    def write_ahead(self, f, depth):
+        parts = queue.Queue(depth)
+        stop = threading.Event()
+        def produce():
+            try:
+                while not stop.is_set():
+                    buffer = self.get_buffer()
+                    view = memoryview(buffer)
+                    fill = 0
+                    while fill < self.partsize:
+                        n = f.readinto(view[fill:])
+                        if not n:
+                            break
+                        fill += n
+                    parts.put((buffer, fill, None))
+                    if fill < self.partsize:
+                        return
+            except Exception as x:
+                parts.put((None, 0, x))
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                buffer, fill, error = parts.get()
+                if error is not None:
+                    raise error
+                if fill:
+                    self.add_part(self.offset, memoryview(buffer)[:fill], buffer)
+                else:
+                    self.put_buffer(buffer)
+                if fill < self.partsize:
+                    break
+        finally:
+            stop.set()
+            while not parts.empty():
+                parts.get_nowait()
 
     def upload_part(self):
+        buffer, fill = self.buffer, self.fill
+        self.buffer = None
+        self.fill = 0
+        self.add_part(self.offset, memoryview(buffer)[:fill], buffer)
+
+    def add_part(self, offset, part, buffer=None):
+        self.offset = offset + len(part)
+        if self.executor is None:
+            self.run_part(offset, part, buffer)
+            return
+        try:
+            while len(self.pending) >= self.maxpending:
+                done, self.pending = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    f.result()
+            self.pending.add(self.executor.submit(self.run_part, offset, part, buffer))
+        except BaseException:
+            self.shutdown()
+            raise
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.pending = set()
+            self.executor.shutdown(cancel_futures=True)
+
+    def run_part(self, offset, part, buffer):
+        try:
+            self.send_part(offset, part)
+        finally:
+            if buffer is not None:
+                self.put_buffer(buffer)
+
+    def send_part(self, offset, part):
+        if self.journal is not None and offset in self.journal.parts:
+            h = sha256tree.treehash(part)
+            if self.journal.parts[offset] != (len(part), h.hexdigest()):
+                raise ResumeError("part at offset {} of {} has changed".format(offset, self.journal.filename))
+            self.hashes[offset] = h
+            return
+        start = time.perf_counter()
+        if self.leaves is not None:
+            first = offset // sha256tree.TreeHash.BLOCK_SIZE
+            count = -(-len(part) // sha256tree.TreeHash.BLOCK_SIZE)
+            linear, h = hashlib.sha256(part), sha256tree.reduce_leaves(self.leaves[first*32:(first+count)*32])
+        else:
+            linear, h = sha256tree.treehash_sha256(part)
+        hash_time = time.perf_counter() - start
         headers = [
-            ("Content-Range", "bytes {}-{}/*".format(self.offset, self.offset + len(self.part) - 1))
+            ("Content-Range", "bytes {}-{}/*".format(offset, offset + len(part) - 1))
         ]
-        r = self.session.request("PUT", "/-/vaults/{}/multipart-uploads/{}".format(self.vault, self.upload_id), headers=headers, data=self.part)
-        self.offset += len(self.part)
-        self.hash.update(self.part)
-        self.part = b""
+        r = self.session.request("PUT", "/-/vaults/{}/multipart-uploads/{}".format(self.vault, self.upload_id), headers=headers, data=part, hashes=(linear, h), hash_time=hash_time)
+        self.hashes[offset] = h
+        if self.journal is not None:
+            self.journal.add(offset, len(part), h.hexdigest())
 
     def finish(self):
-        if self.part:
+        if self.fill:
             self.upload_part()
+        if self.executor is not None:
+            try:
+                for f in concurrent.futures.as_completed(self.pending):
+                    f.result()
+            finally:
+                self.shutdown()
+        if self.hashes:
+            tree_hash = sha256tree.reduce_hashes([self.hashes[x] for x in sorted(self.hashes)])
+        else:
+            tree_hash = hashlib.sha256()
         headers = [
-            ("x-amz-sha256-tree-hash", self.hash.finish().hexdigest()),
+            ("x-amz-sha256-tree-hash", tree_hash.hexdigest()),
             ("x-amz-archive-size", str(self.offset)),
         ]
         r = self.session.request("POST", "/-/vaults/{}/multipart-uploads/{}".format(self.vault, self.upload_id), headers=headers)
+        if self.journal is not None:
+            self.journal.remove()
         return r.info()
 
 class Jokull:
-    def __init__(self):
-        self.host = "glacier.us-east-1.amazonaws.com"
-        with open(os.path.join(os.getenv("HOME"), ".s3crc")) as f:
-            for s in f:
-                a = s.split()
-                if a[0] == "access":
-                    self.access = a[1]
-                if a[0] == "secret":
-                    self.secret = a[1]
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, access=None, secret=None, max_retries=DEFAULT_RETRIES, host=DEFAULT_HOST, port=None, secure=True, metrics=None, hash_cache=None, log_durability=DEFAULT_LOG_DURABILITY, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.pool = ConnectionPool(self.host, pool_size, idle_timeout, port, secure, timeout)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.hash_cache = hash_cache
+        self.hash_cache_path = None
+        self.oplog = None
+        self.log_durability = log_durability
+        self.limit = None
+        self.throttle = None
+        self.max_retries = max_retries
+        self.retry_base = RETRY_BASE
+        self.retry_count = 0
+        self.backoff_time = 0
+        self.lock = threading.Lock()
+        self.dir = os.path.join(os.getenv("HOME"), ".glacier")
+        if access is None or secret is None:
+            access, secret = read_credentials()
+        self.access = access
+        self.secret = secret
+        self.signer = Signer(self.access, self.secret, "us-east-1", "glacier")
+
+    def set_limits(self, max_requests=None, max_rate=None):
+        self.limit = threading.BoundedSemaphore(max_requests) if max_requests else None
+        self.throttle = Throttle(max_rate) if max_rate else None
 
     def log(self, oper, *args):
-        try:
-            lf = open(os.path.join(os.getenv("HOME"), ".glacier", "log"), "a", newline="")
-        except IOError:
-            os.mkdir(os.path.join(os.getenv("HOME"), ".glacier"))
-            lf = open(os.path.join(os.getenv("HOME"), ".glacier", "log"), "a", newline="")
-        writer = csv.writer(lf, lineterminator="\n")
-        writer.writerow((time.time(), oper) + args)
-        lf.close()
+        self.open_log().write(oper, *args)
+
+    def open_log(self):
+        with LOG_LOCK:
+            if self.oplog is None:
+                os.makedirs(self.dir, exist_ok=True)
+                self.oplog = oplog.Log(os.path.join(self.dir, "log"), durability=self.log_durability)
+            return self.oplog
+
+    def open_hash_cache(self):
+        with self.lock:
+            if self.hash_cache is None and self.hash_cache_path is not None:
+                os.makedirs(os.path.dirname(self.hash_cache_path), exist_ok=True)
+                self.hash_cache = sha256tree.HashCache(self.hash_cache_path, leaves=True)
+            return self.hash_cache
+
+    def close(self):
+        if self.oplog is not None:
+            self.oplog.close()
+        if self.hash_cache is not None:
+            self.hash_cache.close()
+        self.pool.close()
 
     def create_vault(self, name):
         r = self.request("PUT", "/-/vaults/{}".format(name))
         self.log("create_vault", name)
 
-    def delete_archive(self, vault, archive):
-        r = self.request("DELETE", "/-/vaults/{}/archives/{}".format(vault, archive))
+    def delete_archive(self, vault, archive, retry_throttling=True):
+        r = self.request("DELETE", "/-/vaults/{}/archives/{}".format(vault, archive), retry_throttling=retry_throttling)
         self.log("delete_archive", vault, archive)
         return r.code == 204
 
+    def delete_archives(self, vault, archives, workers=DEFAULT_DELETE_WORKERS, checkpoint=None):
+        if checkpoint is None:
+            checkpoint = os.path.join(self.dir, "deletes", vault)
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+        try:
+            with open(checkpoint) as f:
+                done = set(x.strip() for x in f)
+        except FileNotFoundError:
+            done = set()
+        self.pool.size = max(self.pool.size, workers)
+        limit = AdaptiveLimit(workers)
+        lock = threading.Lock()
+        with open(checkpoint, "a") as cf:
+            def delete(archive):
+                while True:
+                    limit.acquire()
+                    error = None
+                    try:
+                        self.delete_archive(vault, archive, retry_throttling=False)
+                    except (GlacierError, ConnectionError, TimeoutError, http.client.HTTPException) as x:
+                        error = x
+                    throttled = isinstance(error, GlacierError) and error.code in THROTTLING_CODES
+                    delay = limit.release(throttled)
+                    if not throttled:
+                        break
+                    time.sleep(delay * random.random())
+                if isinstance(error, GlacierError) and error.code == "ResourceNotFoundException":
+                    error = None
+                if error is None:
+                    with lock:
+                        cf.write(archive + "\n")
+                        cf.flush()
+                return archive, error is None, error
+            with concurrent.futures.ThreadPoolExecutor(workers) as e:
+                pending = set()
+                for archive in archives:
+                    archive = archive.strip()
+                    if not archive:
+                        continue
+                    if archive in done:
+                        yield archive, False, None
+                        continue
+                    if len(pending) >= 2 * workers:
+                        finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for f in finished:
+                            yield f.result()
+                    pending.add(e.submit(delete, archive))
+                for f in concurrent.futures.as_completed(pending):
+                    yield f.result()
+
     def delete_vault(self, vault):
         r = self.request("DELETE", "/-/vaults/{}".format(vault))
         self.log("delete_vault", vault)
@@ -123,18 +785,174 @@ class Jokull:
         r = self.request("GET", "/-/vaults/{}".format(vault))
         return json.loads(r.read().decode("UTF-8"))
 
-    def get(self, vault, jobid):
-        r = self.request("GET", "/-/vaults/{}/jobs/{}/output".format(vault, jobid))
+    def describe_job(self, vault, jobid):
+        r = self.request("GET", "/-/vaults/{}/jobs/{}".format(vault, jobid))
+        return json.loads(r.read().decode("UTF-8"))
+
+    def download(self, vault, jobid, filename, chunksize=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS):
+        job = self.describe_job(vault, jobid)
+        size = job.get("ArchiveSizeInBytes")
+        if job.get("Action") != "ArchiveRetrieval" or size is None:
+            r = self.get(vault, jobid)
+            with open(filename, "wb") as f:
+                shutil.copyfileobj(r, f)
+            return job
+        chunksize = chunk_size(chunksize)
+        journal = Journal(os.path.join(self.dir, "downloads", jobid))
+        fd = None
+        if (journal.kind, journal.vault, journal.filename, journal.size) == ("download", vault, os.path.abspath(filename), size) and journal.partsize == chunk_size(journal.partsize):
+            try:
+                fd = os.open(filename, os.O_RDWR)
+            except FileNotFoundError:
+                pass
+        if fd is None:
+            journal.start("download", vault, jobid, chunksize, os.path.abspath(filename), size)
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+            if size > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        try:
+            chunksize = journal.partsize
+            offsets = [x for x in range(0, size, chunksize) if x not in journal.parts]
+            with concurrent.futures.ThreadPoolExecutor(workers) as e:
+                list(e.map(lambda x: self.download_range(vault, jobid, fd, x, min(chunksize, size - x), journal), offsets))
+        finally:
+            os.close(fd)
+        if size > 0:
+            tree_hash = sha256tree.reduce_hashes([sha256tree.Digest(bytes.fromhex(journal.parts[x][1])) for x in sorted(journal.parts)])
+        else:
+            tree_hash = hashlib.sha256()
+        if job.get("SHA256TreeHash") and tree_hash.hexdigest() != job["SHA256TreeHash"]:
+            raise DownloadError("tree hash mismatch for {}: expected {} got {}".format(filename, job["SHA256TreeHash"], tree_hash.hexdigest()))
+        journal.remove()
+        return job
+
+    def download_range(self, vault, jobid, fd, offset, length, journal):
+        r = self.get(vault, jobid, range=(offset, offset + length - 1))
+        h = sha256tree.TreeHash()
+        pos = offset
+        while True:
+            data = r.read(1048576)
+            if not data:
+                break
+            os.pwrite(fd, data, pos)
+            h.update(data)
+            pos += len(data)
+        if pos != offset + length:
+            raise DownloadError("short read for bytes {}-{}: got {} bytes".format(offset, offset + length - 1, pos - offset))
+        tree_hash = h.finish().hexdigest()
+        expected = r.info()["x-amz-sha256-tree-hash"]
+        if expected is not None and expected != tree_hash:
+            raise DownloadError("tree hash mismatch for bytes {}-{}: expected {} got {}".format(offset, offset + length - 1, expected, tree_hash))
+        os.fdatasync(fd)
+        journal.add(offset, length, tree_hash)
+
+    def get(self, vault, jobid, range=None):
+        headers = []
+        if range is not None:
+            headers.append(("Range", "bytes={}-{}".format(*range)))
+        r = self.request("GET", "/-/vaults/{}/jobs/{}/output".format(vault, jobid), headers=headers, stream=True)
         return r
 
-    def list_jobs(self, vault):
-        r = self.request("GET", "/-/vaults/{}/jobs".format(vault))
+    def inventory(self):
+        os.makedirs(self.dir, exist_ok=True)
+        if self.oplog is not None:
+            self.oplog.flush()
+        inv = inventory.Inventory(os.path.join(self.dir, "inventory.db"))
+        inv.sync_log(os.path.join(self.dir, "log"))
+        return inv
+
+    def list_jobs(self, vault, completed=None, marker=None, limit=None):
+        r = self.request("GET", "/-/vaults/{}/jobs".format(vault), query=make_list_query(marker, limit, completed))
         return json.loads(r.read().decode("UTF-8"))
 
-    def list_vaults(self):
-        r = self.request("GET", "/-/vaults")
+    def watch_jobs(self, vault, jobids, interval=DEFAULT_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        pending = set()
+        for jobid in jobids:
+            job = self.describe_job(vault, jobid)
+            if job["Completed"]:
+                yield job
+            else:
+                pending.add(jobid)
+        delay = interval
+        while pending:
+            time.sleep(delay)
+            found = False
+            for job in self.iter_jobs(vault, completed=True):
+                if job["JobId"] in pending:
+                    pending.remove(job["JobId"])
+                    found = True
+                    yield job
+                    if not pending:
+                        break
+            delay = interval if found else min(max_interval, delay * 2)
+
+    def download_jobs(self, vault, jobids, directory, workers=2, interval=DEFAULT_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        def download(job):
+            filename = os.path.join(directory, job["JobId"])
+            try:
+                self.download(vault, job["JobId"], filename)
+                return job, filename, None
+            except (GlacierError, DownloadError, OSError) as x:
+                return job, filename, x
+        events = queue.Queue()
+        stop = threading.Event()
+        def watch():
+            try:
+                for job in self.watch_jobs(vault, jobids, interval=interval, max_interval=max_interval):
+                    if stop.is_set():
+                        return
+                    events.put(("job", job))
+                events.put(("end", None))
+            except Exception as x:
+                events.put(("error", x))
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as e:
+                watching = True
+                active = 0
+                while watching or active:
+                    kind, value = events.get()
+                    if kind == "job":
+                        if value["StatusCode"] == "Succeeded":
+                            active += 1
+                            e.submit(download, value).add_done_callback(lambda f: events.put(("done", f)))
+                        else:
+                            yield value, None, None
+                    elif kind == "done":
+                        active -= 1
+                        yield value.result()
+                    elif kind == "end":
+                        watching = False
+                    else:
+                        raise value
+        finally:
+            stop.set()
+
+    def list_vaults(self, marker=None, limit=None):
+        r = self.request("GET", "/-/vaults", query=make_list_query(marker, limit))
         return json.loads(r.read().decode("UTF-8"))
 
+    def iter_pages(self, fetch, prefetch=False):
+        page = fetch(None)
+        with concurrent.futures.ThreadPoolExecutor(1) as e:
+            while True:
+                marker = page.get("Marker")
+                future = e.submit(fetch, marker) if prefetch and marker else None
+                yield page
+                if not marker:
+                    return
+                page = future.result() if future is not None else fetch(marker)
+
+    def iter_jobs(self, vault, completed=None, prefetch=False):
+        for page in self.iter_pages(lambda marker: self.list_jobs(vault, completed=completed, marker=marker), prefetch):
+            yield from page["JobList"]
+
+    def iter_vaults(self, prefetch=False):
+        for page in self.iter_pages(lambda marker: self.list_vaults(marker=marker), prefetch):
+            yield from page["VaultList"]
+
     def new_job(self, vault, archive_id=None):
         req = {
             "Type": "archive-retrieval" if archive_id else "inventory-retrieval",
@@ -144,62 +962,504 @@ class Jokull:
         r = self.request("POST", "/-/vaults/{}/jobs".format(vault), data=json.dumps(req).encode("UTF-8"))
         return r.info()
 
-    def upload_archive(self, vault, data, filename=None, description=None):
+    def find_duplicate(self, vault, data):
+        if isinstance(data, bytes):
+            tree_hash = sha256tree.treehash(data)
+        else:
+            try:
+                data.fileno()
+                tree_hash = sha256tree.hash_file(data, cache=self.open_hash_cache())
+            except (AttributeError, io.UnsupportedOperation):
+                data.seek(0, os.SEEK_SET)
+                tree_hash = sha256tree.hash_stream(data)
+            data.seek(0, os.SEEK_SET)
+        inv = self.inventory()
+        try:
+            archives = inv.find(vault=vault, tree_hash=tree_hash.hexdigest())
+        finally:
+            inv.close()
+        if not archives:
+            return None
+        r = http.client.HTTPMessage()
+        r["x-amz-archive-id"] = archives[0]["archive_id"]
+        r["x-amz-sha256-tree-hash"] = archives[0]["tree_hash"]
+        return r
+
+    def upload_archive(self, vault, data, filename=None, description=None, workers=DEFAULT_WORKERS, resume=False, dedup=False):
+        if dedup:
+            r = self.find_duplicate(vault, data)
+            if r is not None:
+                self.log("dedup_archive", vault, filename, r["x-amz-archive-id"], r["x-amz-sha256-tree-hash"])
+                return r
+        f = data
+        st = None
         if not isinstance(data, bytes):
             data.seek(0, os.SEEK_END)
             size = data.tell()
             data.seek(0, os.SEEK_SET)
-            if size > 4*1048576:
-                m = self.upload_multipart(vault, description=description or filename)
-                while True:
-                    s = data.read(65536)
-                    if not s:
-                        break
-                    m.write(s)
-                r = m.finish()
+            view = map_file(data, size)
+            if view is not None and self.open_hash_cache() is not None:
+                st = os.fstat(data.fileno())
+            if size > DEFAULT_PART_SIZE:
+                def start():
+                    m = self.upload_multipart(vault, description=description or filename, partsize=part_size(size), workers=workers)
+                    if filename is not None:
+                        m.journal = Journal(os.path.join(self.dir, "uploads", m.upload_id))
+                        m.journal.start("upload", vault, m.upload_id, m.partsize, os.path.abspath(filename), size)
+                    return m
+                m = None
+                if resume and filename is not None:
+                    m = self.resume_multipart(vault, filename, size, workers=workers)
+                if m is None:
+                    r = self.upload_parts(start(), data, view, size, st)
+                else:
+                    try:
+                        r = self.upload_parts(m, data, view, size, st)
+                    except GlacierError as x:
+                        if x.code != "ResourceNotFoundException":
+                            raise
+                        m.shutdown()
+                        m.journal.remove()
+                        r = self.upload_parts(start(), data, view, size, st)
+                self.remember_hash(data, st, r)
                 self.log("upload_archive", vault, filename, r["x-amz-archive-id"], r["x-amz-sha256-tree-hash"])
                 return r
-            data = data.read()
+            data = view if view is not None else data.read()
         headers = []
         headers.append(("x-amz-archive-description", str(description or filename)))
         r = self.request("POST", "/-/vaults/{}/archives".format(vault), headers=headers, data=data)
+        self.remember_hash(f, st, r.info())
         self.log("upload_archive", vault, filename, r.info()["x-amz-archive-id"], r.info()["x-amz-sha256-tree-hash"])
         return r.info()
 
-    def upload_multipart(self, vault, description=None, partsize=4*1048576):
+    def upload_parts(self, m, data, view, size, st):
+        if view is not None:
+            if st is not None:
+                entry = self.hash_cache.get(st)
+                if entry is not None:
+                    m.leaves = entry[1]
+            for offset in range(0, size, m.partsize):
+                m.add_part(offset, view[offset:offset + m.partsize])
+        else:
+            data.seek(0, os.SEEK_SET)
+            m.write_from(data)
+        return m.finish()
+
+    def remember_hash(self, f, st, r):
+        if st is None or sha256tree.identity(os.fstat(f.fileno())) != sha256tree.identity(st):
+            return
+        entry = self.hash_cache.get(st)
+        if entry is None or entry[0].hex() != r["x-amz-sha256-tree-hash"]:
+            self.hash_cache.put(st, bytes.fromhex(r["x-amz-sha256-tree-hash"]))
+
+    def upload_stream(self, vault, f, size=None, partsize=None, description=None, workers=DEFAULT_WORKERS, readahead=DEFAULT_READAHEAD, budget=DEFAULT_BUFFER_BUDGET):
+        if partsize is None:
+            if size is None:
+                try:
+                    st = os.fstat(f.fileno())
+                    if stat.S_ISREG(st.st_mode):
+                        size = st.st_size - f.tell()
+                except (AttributeError, OSError):
+                    pass
+            partsize = part_size(size) if size is not None else DEFAULT_STREAM_PART_SIZE
+        m = self.upload_multipart(vault, description=description, partsize=partsize, workers=workers, budget=budget)
+        m.write_from(f, readahead=readahead)
+        r = m.finish()
+        self.log("upload_archive", vault, description, r["x-amz-archive-id"], r["x-amz-sha256-tree-hash"])
+        return r
+
+    def upload_tree(self, vault, directory, workers=DEFAULT_WORKERS, part_workers=DEFAULT_WORKERS, dedup=False):
+        def upload(path):
+            try:
+                size = os.path.getsize(path)
+                with open(path, "rb") as f:
+                    r = self.upload_archive(vault, f, filename=path, description=os.path.relpath(path, directory), workers=part_workers, dedup=dedup)
+                return path, size, r, None
+            except (GlacierError, OSError, ResumeError) as x:
+                return path, None, None, x
+        paths = (os.path.join(d, x) for d, dirs, files in os.walk(directory) for x in sorted(files))
+        with concurrent.futures.ThreadPoolExecutor(workers) as e:
+            pending = set()
+            for path in paths:
+                if len(pending) >= 2 * workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        yield f.result()
+                pending.add(e.submit(upload, path))
+            for f in concurrent.futures.as_completed(pending):
+                yield f.result()
+
+    def upload_multipart(self, vault, description=None, partsize=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS, budget=DEFAULT_BUFFER_BUDGET):
         headers = [("x-amz-part-size", str(partsize))]
         if description:
             headers.append(("x-amz-archive-description", description))
         r = self.request("POST", "/-/vaults/{}/multipart-uploads".format(vault), headers=headers)
-        return Multipart(self, vault, partsize, r.info()["x-amz-multipart-upload-id"])
-
-    def request(self, method, uri, headers=None, data=None):
-        #print(method, uri)
-        now = time.gmtime(time.time())
-        datetime = time.strftime("%Y%m%dT%H%M%SZ", now)
-        date = time.strftime("%Y%m%d", now)
-        if headers is None:
-            headers = []
-        headers[:0] = [
-            ("Host", self.host),
-            ("Date", datetime),
-            ("x-amz-glacier-version", "2012-06-01"),
-        ]
+        return Multipart(self, vault, partsize, r.info()["x-amz-multipart-upload-id"], workers=workers, budget=budget)
+
+    def resume_multipart(self, vault, filename, size, workers=DEFAULT_WORKERS):
+        try:
+            names = os.listdir(os.path.join(self.dir, "uploads"))
+        except FileNotFoundError:
+            return None
+        paths = [os.path.join(self.dir, "uploads", x) for x in names]
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            journal = Journal(path)
+            if (journal.kind, journal.vault, journal.filename, journal.size) == ("upload", vault, os.path.abspath(filename), size):
+                return Multipart(self, vault, journal.partsize, journal.id, workers=workers, journal=journal)
+        return None
+
+    def request(self, method, uri, headers=None, data=None, hashes=None, stream=False, query=None, hash_time=None, retry_throttling=True):
+        trace = Trace(method, uri)
+        if hash_time is not None:
+            trace.phases["hash"] = hash_time
+        if data is not None and hashes is None:
+            hashes = sha256tree.treehash_sha256(data)
+            trace.phase("hash")
+        attempt = 0
+        while True:
+            try:
+                r = self.send(method, uri, list(headers or []), data, hashes, stream, query, trace)
+            except (GlacierError, ConnectionError, TimeoutError, http.client.HTTPException) as x:
+                throttled = isinstance(x, GlacierError) and x.code in THROTTLING_CODES
+                if attempt >= self.max_retries or not retryable(x, method in IDEMPOTENT_METHODS) or throttled and not retry_throttling:
+                    trace.error = x
+                    self.metrics.record(trace)
+                    raise
+            else:
+                if not stream:
+                    self.metrics.record(trace)
+                return r
+            delay = min(MAX_BACKOFF, self.retry_base * 2 ** attempt) * random.random()
+            with self.lock:
+                self.retry_count += 1
+                self.backoff_time += delay
+            time.sleep(delay)
+            trace.retries += 1
+            trace.phase("backoff")
+            attempt += 1
+
+    def send(self, method, uri, headers, data, hashes, stream, query=None, trace=None):
+        if trace is None:
+            trace = Trace(method, uri)
+        headers = make_headers(self.signer, self.host, method, uri, headers, data, hashes, query)
+        trace.phase("sign")
+        if query:
+            uri += "?" + make_query_string(query)
+        if self.throttle is not None and data is not None:
+            self.throttle.consume(len(data))
+        if self.limit is not None:
+            self.limit.acquire()
+        trace.phase("queue")
+        try:
+            while True:
+                conn, reused = self.pool.get()
+                sent = False
+                try:
+                    if not reused:
+                        conn.connect()
+                        trace.phase("connect")
+                    conn.request(method, uri, body=data, headers=dict(headers))
+                    sent = True
+                    trace.phase("send")
+                    r = conn.getresponse()
+                    trace.phase("wait")
+                except (ConnectionError, TimeoutError, http.client.HTTPException) as x:
+                    conn.close()
+                    x.sent = sent
+                    if reused and isinstance(x, ConnectionError) and (not sent or method in IDEMPOTENT_METHODS):
+                        continue
+                    raise
+                break
+        finally:
+            if self.limit is not None:
+                self.limit.release()
+        trace.status = r.status
         if data is not None:
-            headers.append(("Content-Length", str(len(data))))
-            headers.append(("x-amz-content-sha256", hashlib.sha256(data).hexdigest()))
-            headers.append(("x-amz-sha256-tree-hash", sha256tree.treehash(data).hexdigest()))
-        canonical_request, signed_headers = make_canonical_request(method, uri, headers, data=data)
-        string_to_sign = make_string_to_sign(datetime, date, "us-east-1", "glacier", canonical_request)
-        #print(repr(canonical_request))
-        #print(repr(string_to_sign))
-        headers.append(("Authorization", make_authorization_header(self.access, self.secret, date, "us-east-1", "glacier", signed_headers, string_to_sign)))
-        req = urllib.request.Request("https://{}/{}".format(self.host, uri), headers=dict(headers))
-        req.get_method = lambda: method
+            trace.sent += len(data)
+        if r.status >= 400:
+            body = r.read()
+            release(self.pool, conn, r)
+            trace.received += len(body)
+            trace.phase("receive")
+            raise make_error(r.status, body.decode("UTF-8", "replace"))
+        return Response(self.pool, conn, r, stream=stream, trace=trace, metrics=self.metrics if stream else None)
+
+async def read_response_head(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("connection closed by server")
+    status = int(line.split(None, 2)[1])
+    raw = b""
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        raw += line
+    return status, email.parser.BytesParser(_class=http.client.HTTPMessage).parsebytes(raw)
+
+async def read_response_body(reader, headers):
+    if headers.get("Transfer-Encoding", "").lower() != "chunked":
+        return await reader.readexactly(int(headers.get("Content-Length", 0)))
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+class AsyncResponse:
+    def __init__(self, session, conn, code, headers, body=None):
+        self.session = session
+        self.conn = conn
+        self.code = code
+        self.headers = headers
+        self.fp = io.BytesIO(body) if body is not None else None
+        self.remaining = int(headers.get("Content-Length", 0)) if body is None else 0
+
+    def info(self):
+        return self.headers
+
+    async def read(self, amt=-1):
+        if self.fp is not None:
+            return self.fp.read(amt)
+        n = self.remaining if amt is None or amt < 0 else min(amt, self.remaining)
+        data = await self.conn[0].readexactly(n) if n else b""
+        self.remaining -= n
+        if self.remaining == 0:
+            self.session.release(self.conn, self.headers)
+            self.conn = None
+            self.fp = io.BytesIO()
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn[1].close()
+            self.conn = None
+            self.fp = io.BytesIO()
+
+class AsyncMultipart:
+    def __init__(self, session, vault, partsize, upload_id, workers=DEFAULT_WORKERS):
+        self.session = session
+        self.vault = vault
+        self.partsize = partsize
+        self.upload_id = upload_id
+        self.hashes = {}
+        self.offset = 0
+        self.part = bytearray()
+        self.pending = set()
+        self.maxpending = workers
+
+    async def write(self, data):
+        self.part += data
+        while len(self.part) >= self.partsize:
+            part = bytes(self.part[:self.partsize])
+            del self.part[:self.partsize]
+            await self.add_part(self.offset, part)
+
+    async def add_part(self, offset, part):
+        self.offset = offset + len(part)
+        while len(self.pending) >= self.maxpending:
+            done, self.pending = await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                t.result()
+        self.pending.add(asyncio.ensure_future(self.send_part(offset, part)))
+
+    async def send_part(self, offset, part):
+        linear, h = await asyncio.get_running_loop().run_in_executor(None, sha256tree.treehash_sha256, part)
+        headers = [
+            ("Content-Range", "bytes {}-{}/*".format(offset, offset + len(part) - 1))
+        ]
+        await self.session.request("PUT", "/-/vaults/{}/multipart-uploads/{}".format(self.vault, self.upload_id), headers=headers, data=part, hashes=(linear, h))
+        self.hashes[offset] = h
+
+    async def finish(self):
+        if self.part:
+            part, self.part = bytes(self.part), bytearray()
+            await self.add_part(self.offset, part)
         try:
-            r = urllib.request.urlopen(req, data)
-        except urllib.error.HTTPError as x:
-            r = x.read().decode("UTF-8")
-            e = json.loads(r)
-            raise GlacierError(x.code, e["code"], e["message"], e["type"]) from x
-        return r
+            await asyncio.gather(*self.pending)
+        finally:
+            self.pending = set()
+        if self.hashes:
+            tree_hash = sha256tree.reduce_hashes([self.hashes[x] for x in sorted(self.hashes)])
+        else:
+            tree_hash = hashlib.sha256()
+        headers = [
+            ("x-amz-sha256-tree-hash", tree_hash.hexdigest()),
+            ("x-amz-archive-size", str(self.offset)),
+        ]
+        r = await self.session.request("POST", "/-/vaults/{}/multipart-uploads/{}".format(self.vault, self.upload_id), headers=headers)
+        return r.info()
+
+class AsyncJokull:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, pool_size=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, access=None, secret=None, host=DEFAULT_HOST, port=None, secure=True, log_durability=DEFAULT_LOG_DURABILITY):
+        self.host = host
+        self.port = port if port is not None else 443 if secure else 80
+        self.ssl = True if secure else None
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.pool_size = pool_size if pool_size is not None else concurrency
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.dir = os.path.join(os.getenv("HOME"), ".glacier")
+        if access is None or secret is None:
+            access, secret = read_credentials()
+        self.access = access
+        self.secret = secret
+        self.signer = Signer(self.access, self.secret, "us-east-1", "glacier")
+        self.oplog = None
+        self.log_durability = log_durability
+
+    log = Jokull.log
+    open_log = Jokull.open_log
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def get_connection(self):
+        now = time.monotonic()
+        while self.idle:
+            conn, last = self.idle.pop()
+            if now - last < self.idle_timeout:
+                return conn, True
+            conn[1].close()
+        return await self.connect(), False
+
+    def release(self, conn, headers):
+        if headers.get("Connection", "").lower() == "close" or len(self.idle) >= self.pool_size:
+            conn[1].close()
+        else:
+            self.idle.append((conn, time.monotonic()))
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for conn, last in idle:
+            conn[1].close()
+            await conn[1].wait_closed()
+        if self.oplog is not None:
+            self.oplog.close()
+
+    async def create_vault(self, name):
+        r = await self.request("PUT", "/-/vaults/{}".format(name))
+        self.log("create_vault", name)
+
+    async def delete_archive(self, vault, archive):
+        r = await self.request("DELETE", "/-/vaults/{}/archives/{}".format(vault, archive))
+        self.log("delete_archive", vault, archive)
+        return r.code == 204
+
+    async def delete_vault(self, vault):
+        r = await self.request("DELETE", "/-/vaults/{}".format(vault))
+        self.log("delete_vault", vault)
+        return r.code == 204
+
+    async def describe_vault(self, vault):
+        r = await self.request("GET", "/-/vaults/{}".format(vault))
+        return json.loads((await r.read()).decode("UTF-8"))
+
+    async def describe_job(self, vault, jobid):
+        r = await self.request("GET", "/-/vaults/{}/jobs/{}".format(vault, jobid))
+        return json.loads((await r.read()).decode("UTF-8"))
+
+    async def get(self, vault, jobid, range=None):
+        headers = []
+        if range is not None:
+            headers.append(("Range", "bytes={}-{}".format(*range)))
+        return await self.request("GET", "/-/vaults/{}/jobs/{}/output".format(vault, jobid), headers=headers, stream=True)
+
+    async def list_jobs(self, vault, completed=None, marker=None, limit=None):
+        r = await self.request("GET", "/-/vaults/{}/jobs".format(vault), query=make_list_query(marker, limit, completed))
+        return json.loads((await r.read()).decode("UTF-8"))
+
+    async def list_vaults(self, marker=None, limit=None):
+        r = await self.request("GET", "/-/vaults", query=make_list_query(marker, limit))
+        return json.loads((await r.read()).decode("UTF-8"))
+
+    async def iter_pages(self, fetch, prefetch=False):
+        page = await fetch(None)
+        while True:
+            marker = page.get("Marker")
+            task = asyncio.ensure_future(fetch(marker)) if prefetch and marker else None
+            yield page
+            if not marker:
+                return
+            page = await task if task is not None else await fetch(marker)
+
+    async def iter_jobs(self, vault, completed=None, prefetch=False):
+        async for page in self.iter_pages(lambda marker: self.list_jobs(vault, completed=completed, marker=marker), prefetch):
+            for job in page["JobList"]:
+                yield job
+
+    async def iter_vaults(self, prefetch=False):
+        async for page in self.iter_pages(lambda marker: self.list_vaults(marker=marker), prefetch):
+            for vault in page["VaultList"]:
+                yield vault
+
+    async def new_job(self, vault, archive_id=None):
+        req = {
+            "Type": "archive-retrieval" if archive_id else "inventory-retrieval",
+        }
+        if archive_id:
+            req["ArchiveId"] = archive_id
+        r = await self.request("POST", "/-/vaults/{}/jobs".format(vault), data=json.dumps(req).encode("UTF-8"))
+        return r.info()
+
+    async def upload_archive(self, vault, data, filename=None, description=None, workers=DEFAULT_WORKERS):
+        if not isinstance(data, bytes):
+            data.seek(0, os.SEEK_END)
+            size = data.tell()
+            data.seek(0, os.SEEK_SET)
+            view = map_file(data, size)
+            data = view if view is not None else data.read()
+        if len(data) > DEFAULT_PART_SIZE:
+            m = await self.upload_multipart(vault, description=description or filename, partsize=part_size(len(data)), workers=workers)
+            for offset in range(0, len(data), m.partsize):
+                await m.add_part(offset, data[offset:offset + m.partsize])
+            r = await m.finish()
+            self.log("upload_archive", vault, filename, r["x-amz-archive-id"], r["x-amz-sha256-tree-hash"])
+            return r
+        headers = []
+        headers.append(("x-amz-archive-description", str(description or filename)))
+        r = await self.request("POST", "/-/vaults/{}/archives".format(vault), headers=headers, data=data)
+        self.log("upload_archive", vault, filename, r.info()["x-amz-archive-id"], r.info()["x-amz-sha256-tree-hash"])
+        return r.info()
+
+    async def upload_multipart(self, vault, description=None, partsize=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS):
+        headers = [("x-amz-part-size", str(partsize))]
+        if description:
+            headers.append(("x-amz-archive-description", description))
+        r = await self.request("POST", "/-/vaults/{}/multipart-uploads".format(vault), headers=headers)
+        return AsyncMultipart(self, vault, partsize, r.info()["x-amz-multipart-upload-id"], workers=workers)
+
+    async def request(self, method, uri, headers=None, data=None, hashes=None, stream=False, query=None):
+        headers = make_headers(self.signer, self.host, method, uri, headers, data, hashes, query)
+        if query:
+            uri += "?" + make_query_string(query)
+        if data is None and method in ("POST", "PUT"):
+            headers.append(("Content-Length", "0"))
+        head = "".join("{}: {}\r\n".format(k, v) for k, v in headers)
+        head = "{} {} HTTP/1.1\r\n{}\r\n".format(method, uri, head).encode("latin-1")
+        async with self.concurrency:
+            while True:
+                conn, reused = await self.get_connection()
+                try:
+                    conn[1].write(head)
+                    if data is not None:
+                        conn[1].write(data)
+                    await conn[1].drain()
+                    code, rheaders = await read_response_head(conn[0])
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn[1].close()
+                    if reused:
+                        continue
+                    raise
+                break
+            if code < 400 and stream and "Content-Length" in rheaders:
+                return AsyncResponse(self, conn, code, rheaders)
+            body = await read_response_body(conn[0], rheaders)
+            self.release(conn, rheaders)
+        if code >= 400:
+            raise make_error(code, body.decode("UTF-8", "replace"))
+        return AsyncResponse(self, None, code, rheaders, body)
@@ -0,0 +1,206 @@
+import atexit
+import csv
+import fcntl
+import io
+import json
+import os
+import re
+import threading
+import time
+
+MAX_SEGMENT_SIZE = 64 * 2 ** 20
+FLUSH_INTERVAL = 1.0
+BUFFER_SIZE = 64 * 1024
+MARK_INTERVAL = 1024
+
+def segment_name(path, number):
+    return "{}.{:06}".format(path, number)
+
+def segments(path):
+    directory, base = os.path.split(path)
+    pattern = re.compile(re.escape(base) + r"\.(\d+)")
+    try:
+        names = os.listdir(directory or ".")
+    except FileNotFoundError:
+        names = []
+    numbers = sorted(int(m.group(1)) for m in map(pattern.fullmatch, names) if m)
+    return [(x, segment_name(path, x)) for x in numbers] + [((numbers[-1] if numbers else 0) + 1, path)]
+
+def parse_rows(data, offset=0):
+    pos = [offset]
+    def lines():
+        for line in io.BytesIO(data):
+            pos[0] += len(line)
+            yield line.decode("UTF-8")
+    for row in csv.reader(lines()):
+        yield row, pos[0]
+
+def read_rows(filename, offset=0):
+    try:
+        f = open(filename, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(0, io.SEEK_END)
+        if f.tell() < offset:
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+    yield from parse_rows(data[:data.rfind(b"\n") + 1], offset)
+
+def build_index(filename):
+    index = {"start": None, "end": None, "rows": 0, "vaults": [], "marks": []}
+    vaults = set()
+    latest = None
+    offset = 0
+    for row, end in read_rows(filename):
+        if index["rows"] % MARK_INTERVAL == 0 and latest is not None:
+            index["marks"].append([offset, latest])
+        t = float(row[0])
+        latest = t if latest is None else max(latest, t)
+        index["start"] = t if index["start"] is None else min(index["start"], t)
+        if len(row) > 2:
+            vaults.add(row[2])
+        index["rows"] += 1
+        offset = end
+    index["end"] = latest
+    index["vaults"] = sorted(vaults)
+    return index
+
+def read_index(filename):
+    try:
+        with open(filename + ".idx") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+class Log:
+    def __init__(self, path, durability="periodic", interval=FLUSH_INTERVAL, max_size=MAX_SEGMENT_SIZE):
+        if durability not in ("op", "periodic"):
+            raise ValueError("unknown durability: {}".format(durability))
+        self.path = path
+        self.durability = durability
+        self.interval = interval
+        self.max_size = max_size
+        self.buffer = []
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.flusher = None
+        self.fd = self.open()
+        atexit.register(self.close)
+
+    def open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, oper, *args):
+        out = io.StringIO()
+        csv.writer(out, lineterminator="\n").writerow((time.time(), oper) + args)
+        line = out.getvalue().encode("UTF-8")
+        with self.lock:
+            if self.fd is None:
+                raise ValueError("write to closed log")
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.durability == "op" or self.buffered >= BUFFER_SIZE:
+                self.flush_locked()
+            elif self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+                self.flusher.start()
+
+    def run_flusher(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None:
+                self.flush_locked()
+
+    def flush_locked(self):
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_ino == os.fstat(self.fd).st_ino:
+                break
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+            self.fd = self.open()
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            os.fsync(self.fd)
+            self.buffer = []
+            self.buffered = 0
+            if os.fstat(self.fd).st_size >= self.max_size:
+                self.rotate()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def rotate(self):
+        number, _ = segments(self.path)[-1]
+        name = segment_name(self.path, number)
+        with open(name + ".idx.tmp", "w") as f:
+            json.dump(build_index(self.path), f)
+        os.rename(name + ".idx.tmp", name + ".idx")
+        os.rename(self.path, name)
+
+    def close(self):
+        self.stop.set()
+        with self.lock:
+            if self.fd is None:
+                return
+            self.flush_locked()
+            os.close(self.fd)
+            self.fd = None
+        atexit.unregister(self.close)
+
+class LogReader:
+    def __init__(self, path):
+        self.path = path
+
+    def read_from(self, segment=1, offset=0):
+        files = segments(self.path)
+        if segment > files[-1][0]:
+            segment, offset = files[-1][0], 0
+        for number, filename in files:
+            if number < segment:
+                continue
+            for row, end in read_rows(filename, offset if number == segment else 0):
+                yield number, end, row
+
+    def read(self, since=None, until=None, vault=None):
+        for number, filename in segments(self.path):
+            index = read_index(filename) if filename != self.path else None
+            offset = 0
+            if index is not None:
+                if index["rows"] == 0:
+                    continue
+                if since is not None and index["end"] < since:
+                    continue
+                if until is not None and index["start"] >= until:
+                    continue
+                if vault is not None and vault not in index["vaults"]:
+                    continue
+                if since is not None:
+                    for mark, latest in index["marks"]:
+                        if latest >= since:
+                            break
+                        offset = mark
+            for row, end in read_rows(filename, offset):
+                t = float(row[0])
+                if since is not None and t < since:
+                    continue
+                if until is not None and t >= until:
+                    continue
+                if vault is not None and row[2:3] != [vault]:
+                    continue
+                yield row
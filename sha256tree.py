@@ -1,54 +1,123 @@
-import functools
+import concurrent.futures
 import hashlib
+import itertools
 import mmap
 import os
+import sqlite3
 import sys
+import threading
+import time
+
+CHUNK_SIZE = 64 * 2 ** 20
+CACHE_SIZE = 256 * 2 ** 20
+RACY_WINDOW = 2 * 10 ** 9
+
+class Digest:
+    def __init__(self, digest):
+        self.value = digest
+    def digest(self):
+        return self.value
+    def hexdigest(self):
+        return self.value.hex()
 
 class TreeHash:
     BLOCK_SIZE = 2 ** 20
     def __init__(self, hasher=hashlib.sha256):
         self.hasher = hasher
-        self.tree = []
+        self.stack = bytearray()
+        self.blocks = 0
         self.hash = self.hasher()
         self.len = 0
+    def push(self, digest, level=0):
+        if self.len or self.blocks & ((1 << level) - 1):
+            raise ValueError("subtree of {} blocks is not aligned at block {}".format(1 << level, self.blocks))
+        n = self.blocks >> level
+        while n & 1:
+            digest = self.hasher(self.stack[-32:] + digest).digest()
+            del self.stack[-32:]
+            n >>= 1
+        self.stack += digest
+        self.blocks += 1 << level
     def update(self, data):
-        if len(data) == 0:
+        if type(data) in (bytes, bytearray) and self.len + len(data) < TreeHash.BLOCK_SIZE:
+            self.hash.update(data)
+            self.len += len(data)
             return
-        index = 0
-        while True:
-            needed_for_block = TreeHash.BLOCK_SIZE - self.len
-            next_chunk = data[index:index+needed_for_block]
-            index += len(next_chunk)
-            self.len += len(next_chunk)
-            self.hash.update(next_chunk)
+        view = memoryview(data).cast("B")
+        if self.len:
+            n = min(len(view), TreeHash.BLOCK_SIZE - self.len)
+            self.hash.update(view[:n])
+            self.len += n
+            view = view[n:]
             if self.len < TreeHash.BLOCK_SIZE:
-                break
-            assert self.len == TreeHash.BLOCK_SIZE, self.len
-            for i in range(len(self.tree)):
-                if self.tree[i] is None:
-                    self.tree[i] = self.hash
-                    break
-                else:
-                    self.hash = self.hasher(self.tree[i].digest() + self.hash.digest())
-                    self.tree[i] = None
-            else:
-                self.tree.append(self.hash)
-            #print([x.hexdigest() if x is not None else None for x in self.tree])
+                return
+            digest = self.hash.digest()
             self.hash = self.hasher()
             self.len = 0
+            self.push(digest)
+        while len(view) >= TreeHash.BLOCK_SIZE:
+            self.push(self.hasher(view[:TreeHash.BLOCK_SIZE]).digest())
+            view = view[TreeHash.BLOCK_SIZE:]
+        if view:
+            self.hash.update(view)
+            self.len = len(view)
+    def update_from(self, f):
+        buf = memoryview(bytearray(TreeHash.BLOCK_SIZE))
+        total = 0
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return total
+            self.update(buf[:n])
+            total += n
+    def copy(self):
+        h = TreeHash(self.hasher)
+        h.stack = bytearray(self.stack)
+        h.blocks = self.blocks
+        h.hash = self.hash.copy()
+        h.len = self.len
+        return h
+    def merge(self, other):
+        levels = [x for x in reversed(range(other.blocks.bit_length())) if other.blocks >> x & 1]
+        if self.len or levels and self.blocks & ((1 << levels[0]) - 1):
+            raise ValueError("segment of {} blocks is not aligned at block {}".format(other.blocks, self.blocks))
+        for i, level in enumerate(levels):
+            self.push(bytes(other.stack[i*32:i*32+32]), level)
+        if other.len:
+            self.hash = other.hash.copy()
+            self.len = other.len
+    def size(self):
+        return self.blocks * TreeHash.BLOCK_SIZE + self.len
     def finish(self):
-        if self.len > 0:
-            self.tree = [self.hash] + self.tree
-        if self.tree:
-            return functools.reduce(lambda x, y: self.hasher(y.digest() + x.digest()), [x for x in self.tree if x is not None])
+        if self.len:
+            digest = self.hash.digest()
+        elif self.stack:
+            digest = bytes(self.stack[-32:])
         else:
-            return self.hash
+            return Digest(self.hash.digest())
+        for x in range(len(self.stack) // 32 - (0 if self.len else 1) - 1, -1, -1):
+            digest = self.hasher(self.stack[x*32:x*32+32] + digest).digest()
+        return Digest(digest)
+    def digest(self):
+        return self.finish().digest()
+    def hexdigest(self):
+        return self.finish().hexdigest()
 
 def treehash(data):
     h = TreeHash()
     h.update(data)
     return h.finish()
 
+def treehash_sha256(data):
+    view = memoryview(data).cast("B")
+    linear = hashlib.sha256()
+    hashes = []
+    for x in range(0, len(view), TreeHash.BLOCK_SIZE):
+        block = view[x:x+TreeHash.BLOCK_SIZE]
+        linear.update(block)
+        hashes.append(hashlib.sha256(block))
+    return linear, reduce_hashes(hashes) if hashes else hashlib.sha256()
+
 def reduce_hashes(hashes):
     while len(hashes) > 1:
         newhashes = []
@@ -60,12 +129,46 @@ def reduce_hashes(hashes):
         hashes = newhashes
     return hashes[0]
 
-def treehash_parallel(f):
+def hash_view(view):
+    return reduce_hashes([hashlib.sha256(view[x:x+TreeHash.BLOCK_SIZE]) for x in range(0, len(view), TreeHash.BLOCK_SIZE)]).digest()
+
+def hash_leaves(view):
+    return b"".join(hashlib.sha256(view[x:x+TreeHash.BLOCK_SIZE]).digest() for x in range(0, len(view), TreeHash.BLOCK_SIZE))
+
+def reduce_leaves(leaves):
+    if not leaves:
+        return hashlib.sha256()
+    return reduce_hashes([Digest(bytes(leaves[x:x+32])) for x in range(0, len(leaves), 32)])
+
+def hash_range(filename, offset, length, fn=hash_view):
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as m:
+            with memoryview(m) as view:
+                return fn(view)
+
+def map_chunks(f, fn, workers=None, processes=False):
     f.seek(0, os.SEEK_END)
     size = f.tell()
-    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
-    hashes = list(map(lambda x: hashlib.sha256(m[x:x+1048576]), range(0, size, 1048576)))
-    return reduce_hashes(hashes)
+    if size == 0:
+        return []
+    offsets = range(0, size, CHUNK_SIZE)
+    lengths = [min(CHUNK_SIZE, size - x) for x in offsets]
+    if processes:
+        with concurrent.futures.ProcessPoolExecutor(workers) as e:
+            return list(e.map(hash_range, itertools.repeat(f.name), offsets, lengths, itertools.repeat(fn)))
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+        with memoryview(m) as view:
+            with concurrent.futures.ThreadPoolExecutor(workers) as e:
+                return list(e.map(lambda x, n: fn(view[x:x+n]), offsets, lengths))
+
+def treehash_parallel(f, workers=None, processes=False):
+    hashes = map_chunks(f, hash_view, workers, processes)
+    if not hashes:
+        return hashlib.sha256()
+    return reduce_hashes([Digest(x) for x in hashes])
+
+def leaves_parallel(f, workers=None, processes=False):
+    return b"".join(map_chunks(f, hash_leaves, workers, processes))
 
 def treehash_simple(data):
     if not data:
@@ -73,11 +176,120 @@ def treehash_simple(data):
     hashes = [hashlib.sha256(data[x:x+1048576]) for x in range(0, len(data), 1048576)]
     return reduce_hashes(hashes)
 
-def hash_file(f):
-    return treehash_parallel(f)
+def identity(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+class HashCache:
+    def __init__(self, path, max_size=CACHE_SIZE, leaves=False):
+        self.max_size = max_size
+        self.leaves = leaves
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("""
+                create table if not exists hashes (
+                    dev integer,
+                    ino integer,
+                    size integer,
+                    mtime_ns integer,
+                    ctime_ns integer,
+                    tree_hash blob,
+                    leaves blob,
+                    cost integer,
+                    last_used integer,
+                    primary key (dev, ino)
+                )
+            """)
+            if "ctime_ns" not in [x[1] for x in self.db.execute("pragma table_info(hashes)")]:
+                self.db.execute("alter table hashes add column ctime_ns integer")
+            self.db.execute("create index if not exists hashes_last_used on hashes (last_used)")
+            self.db.execute("create table if not exists meta (key text primary key, value integer)")
+            self.db.execute("insert or ignore into meta (key, value) select 'total', coalesce(sum(cost), 0) from hashes")
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            with self.db:
+                self.flush_touched()
+            self.db.close()
+            self.db = None
+
+    def flush_touched(self):
+        if self.touched:
+            self.db.executemany("update hashes set last_used = ? where dev = ? and ino = ?", [(t, dev, ino) for (dev, ino), t in self.touched.items()])
+            self.touched = {}
+
+    def remove(self, st):
+        row = self.db.execute("select cost from hashes where dev = ? and ino = ?", (st.st_dev, st.st_ino)).fetchone()
+        if row is not None:
+            self.db.execute("delete from hashes where dev = ? and ino = ?", (st.st_dev, st.st_ino))
+            self.db.execute("update meta set value = value - ? where key = 'total'", (row[0],))
+
+    def get(self, st):
+        with self.lock:
+            row = self.db.execute("select size, mtime_ns, ctime_ns, tree_hash, leaves from hashes where dev = ? and ino = ?", (st.st_dev, st.st_ino)).fetchone()
+            if row is None:
+                return None
+            if row[:3] != (st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+                with self.db:
+                    self.remove(st)
+                return None
+            self.touched[st.st_dev, st.st_ino] = time.time_ns()
+            return row[3], row[4]
+
+    def put(self, st, tree_hash, leaves=None):
+        if st.st_mtime_ns >= time.time_ns() - RACY_WINDOW:
+            return
+        cost = 100 + len(tree_hash) + (len(leaves) if leaves is not None else 0)
+        with self.lock, self.db:
+            self.flush_touched()
+            self.remove(st)
+            self.db.execute("""
+                insert into hashes (dev, ino, size, mtime_ns, ctime_ns, tree_hash, leaves, cost, last_used)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, tree_hash, leaves, cost, time.time_ns()))
+            self.db.execute("update meta set value = value + ? where key = 'total'", (cost,))
+            total = self.db.execute("select value from meta where key = 'total'").fetchone()[0]
+            while total > self.max_size:
+                rows = self.db.execute("select rowid, cost from hashes order by last_used limit 64").fetchall()
+                if not rows:
+                    break
+                freed = 0
+                for rowid, cost in rows:
+                    self.db.execute("delete from hashes where rowid = ?", (rowid,))
+                    freed += cost
+                    if total - freed <= self.max_size:
+                        break
+                self.db.execute("update meta set value = value - ? where key = 'total'", (freed,))
+                total -= freed
+
+    def lookup(self, f, workers=None, processes=False):
+        st = os.fstat(f.fileno())
+        entry = self.get(st)
+        if entry is not None and (entry[1] is not None or not self.leaves):
+            return entry
+        if self.leaves:
+            leaves = leaves_parallel(f, workers, processes)
+            tree_hash = reduce_leaves(leaves).digest()
+        else:
+            leaves = None
+            tree_hash = treehash_parallel(f, workers, processes).digest()
+        if identity(os.fstat(f.fileno())) == identity(st):
+            self.put(st, tree_hash, leaves)
+        return tree_hash, leaves
+
+def hash_file(f, workers=None, processes=False, cache=None):
+    if cache is not None:
+        return Digest(cache.lookup(f, workers=workers, processes=processes)[0])
+    return treehash_parallel(f, workers=workers, processes=processes)
 
 def hash_stream(f):
     h = TreeHash()
+    if hasattr(f, "readinto"):
+        h.update_from(f)
+        return h.finish()
     while True:
         s = f.read(65536)
         if not s:
@@ -86,13 +298,32 @@ def hash_stream(f):
     return h.finish()
 
 def main():
-    if len(sys.argv) >= 2:
-        for fn in sys.argv[1:]:
-            with open(fn, "rb") as f:
-                h = hash_file(f)
-                print("{} {}".format(h.hexdigest(), fn))
-    else:
-        print(hash_stream(sys.stdin.detach()).hexdigest())
+    args = sys.argv[1:]
+    workers = None
+    processes = False
+    cache = None
+    while args and args[0].startswith("-"):
+        a = args.pop(0)
+        if a == "-j":
+            workers = int(args.pop(0))
+        elif a == "-p":
+            processes = True
+        elif a == "-c":
+            cache = HashCache(args.pop(0))
+        else:
+            print("Unknown option: {}".format(a))
+            sys.exit(1)
+    try:
+        if args:
+            for fn in args:
+                with open(fn, "rb") as f:
+                    h = hash_file(f, workers=workers, processes=processes, cache=cache)
+                    print("{} {}".format(h.hexdigest(), fn))
+        else:
+            print(hash_stream(sys.stdin.detach()).hexdigest())
+    finally:
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,24 @@
+import asyncio
+import csv
+import hashlib
+import http.client
 import io
 import itertools
 import json
+import multiprocessing
 import os
 import random
 import re
+import socket
+import sys
+import tempfile
+import threading
+import time
 
+import benchmark
+import fakeglacier
+import inventory
+import oplog
 import sha256tree
 import libjokull
 import jokull
@@ -16,6 +30,7 @@ def test_signatures():
     date = "20110909"
     region = "us-east-1"
     service = "host"
+    signer = libjokull.Signer(access, secret_key, region, service)
 
     for fn in [x for x in os.listdir("aws4_testsuite") if x.endswith(".req")]:
         print(fn)
@@ -48,23 +63,30 @@ def test_signatures():
         assert string_to_sign == open(os.path.join("aws4_testsuite", fn + ".sts"), encoding="UTF-8").read(), repr(string_to_sign)
         authorization = libjokull.make_authorization_header(access, secret_key, date, region, service, signed_headers, string_to_sign)
         assert authorization == open(os.path.join("aws4_testsuite", fn + ".authz"), encoding="UTF-8").read(), repr(authorization)
+        authorization = signer.sign(method, uri, headers, datetime, query=query, data=data.encode())
+        assert authorization == open(os.path.join("aws4_testsuite", fn + ".authz"), encoding="UTF-8").read(), repr(authorization)
 
-def test_cmdline():
-    class StubJokull:
-        def __init__(self):
-            self.calls = []
-            self.response = {}
-        def set_response(self, method, r):
-            self.response[method] = r
-        def __getattr__(self, name):
-            def method(*args, **kwargs):
-                if kwargs:
-                    self.calls.append((name, args, kwargs))
-                else:
-                    self.calls.append((name, args))
-                return self.response.get(name)
-            return method
+    key = signer.signing_key(date)
+    assert signer.signing_key(date) is key
+    assert signer.signing_key("20110910") != key
+    assert signer.signing_key(date) == key
+
+class StubJokull:
+    def __init__(self):
+        self.calls = []
+        self.response = {}
+    def set_response(self, method, r):
+        self.response[method] = r
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            if kwargs:
+                self.calls.append((name, args, kwargs))
+            else:
+                self.calls.append((name, args))
+            return self.response.get(name)
+        return method
 
+def test_cmdline():
     class Headers:
         def __init__(self, h):
             self.h = h
@@ -107,16 +129,15 @@ def test_cmdline():
 """, o.getvalue()
 
     o = io.StringIO()
-    s.set_response("get", io.BytesIO(json.dumps({}).encode("UTF-8")))
     jokull.do_get(o, s, ["jokull", "get", "test-vault", "test-jobid", "test-output"])
-    assert s.calls[-1] == ("get", ("test-vault", "test-jobid")), s.calls[-1]
+    assert s.calls[-1] == ("download", ("test-vault", "test-jobid", "test-output")), s.calls[-1]
     assert o.getvalue() == "", o.getvalue()
 
     o = io.StringIO()
-    s.set_response("list_jobs", {'JobList': [], 'Marker': None})
+    s.set_response("iter_jobs", iter([{'Action': 'InventoryRetrieval', 'JobId': 'job-a'}, {'Action': 'ArchiveRetrieval', 'JobId': 'job-b'}]))
     jokull.do_jobs(o, s, ["jokull", "jobs", "test-vault"])
-    assert s.calls[-1] == ("list_jobs", ("test-vault",)), s.calls[-1]
-    assert o.getvalue() == "{'JobList': [], 'Marker': None}\n", o.getvalue()
+    assert s.calls[-1] == ("iter_jobs", ("test-vault",), {"prefetch": True}), s.calls[-1]
+    assert o.getvalue() == "{'Action': 'InventoryRetrieval', 'JobId': 'job-a'}\n{'Action': 'ArchiveRetrieval', 'JobId': 'job-b'}\n", o.getvalue()
 
     o = io.StringIO()
     s.set_response("new_job", Headers([
@@ -159,9 +180,13 @@ Date: Wed, 19 Sep 2012 09:32:01 GMT
         ("Content-Length", "2"),
         ("Date", "Wed, 19 Sep 2012 09:39:13 GMT"),
     ]))
-    jokull.do_upload(o, s, ["jokull", "upload", "test-vault", "test-output"])
+    upload = tempfile.NamedTemporaryFile()
+    upload.write(b"{}")
+    upload.flush()
+    jokull.do_upload(o, s, ["jokull", "upload", "test-vault", upload.name])
     assert s.calls[-1][0] == "upload_archive", s.calls[-1]
     assert s.calls[-1][1][0] == "test-vault", s.calls[-1]
+    assert s.calls[-1][2]["resume"] is False, s.calls[-1]
     assert o.getvalue() == """x-amzn-RequestId: 8uQMwaiyuQoY1Myyu1-oXfjFhLKEczQBfuMPOeaIN7aHmdY
 x-amz-sha256-tree-hash: d927ff3f59f955539eeacdeb05285b569ae51f8e56f9d375ba98393e4d67f287
 Location: /999999999999/vaults/test/archives/itP-uHkoD8hMcZGjgcKs6fi94smBWKZ0_gk0IkWDy8vUNtiyeJhApgv1kXcMkapq65nm-uAwOgDucLymS6PsawDT_KeTBKY8A0lhbszNdL9yefFOXCaMI-AZBtavlWADUPaEJMZ39g
@@ -171,26 +196,36 @@ Content-Length: 2
 Date: Wed, 19 Sep 2012 09:39:13 GMT
 
 """, o.getvalue()
+    o = io.StringIO()
+    jokull.do_upload(o, s, ["jokull", "upload", "--resume", "test-vault", upload.name])
+    assert s.calls[-1][1][0] == "test-vault", s.calls[-1]
+    assert s.calls[-1][2]["resume"] is True, s.calls[-1]
+    o = io.StringIO()
+    jokull.do_upload(o, s, ["jokull", "upload", "test-vault", upload.name, "--dedup"])
+    assert s.calls[-1][1][0] == "test-vault", s.calls[-1]
+    assert s.calls[-1][2]["dedup"] is True, s.calls[-1]
+    o = io.StringIO()
+    jokull.do_upload(o, s, ["jokull", "upload", "--workers", "3", "test-vault", upload.name])
+    assert s.calls[-1][2]["workers"] == 3, s.calls[-1]
+    upload.close()
 
     o = io.StringIO()
-    s.set_response("list_vaults",
-        {'Marker': None,
-         'VaultList': [{'CreationDate': '2012-09-18T08:45:11.663Z',
-                        'LastInventoryDate': '2012-09-19T00:08:00.697Z',
-                        'NumberOfArchives': 0,
-                        'SizeInBytes': 0,
-                        'VaultARN': 'arn:aws:glacier:us-east-1:999999999999:vaults/test-vault',
-                        'VaultName': 'test-vault'}]}
-    )
+    s.set_response("iter_vaults", iter(
+        [{'CreationDate': '2012-09-18T08:45:11.663Z',
+          'LastInventoryDate': '2012-09-19T00:08:00.697Z',
+          'NumberOfArchives': 0,
+          'SizeInBytes': 0,
+          'VaultARN': 'arn:aws:glacier:us-east-1:999999999999:vaults/test-vault',
+          'VaultName': 'test-vault'}]
+    ))
     jokull.do_vaults(o, s, ["jokull", "vaults"])
-    assert s.calls[-1] == ("list_vaults", ()), s.calls[-1]
-    assert o.getvalue() == """{'Marker': None,
- 'VaultList': [{'CreationDate': '2012-09-18T08:45:11.663Z',
-                'LastInventoryDate': '2012-09-19T00:08:00.697Z',
-                'NumberOfArchives': 0,
-                'SizeInBytes': 0,
-                'VaultARN': 'arn:aws:glacier:us-east-1:999999999999:vaults/test-vault',
-                'VaultName': 'test-vault'}]}
+    assert s.calls[-1] == ("iter_vaults", (), {"prefetch": True}), s.calls[-1]
+    assert o.getvalue() == """{'CreationDate': '2012-09-18T08:45:11.663Z',
+ 'LastInventoryDate': '2012-09-19T00:08:00.697Z',
+ 'NumberOfArchives': 0,
+ 'SizeInBytes': 0,
+ 'VaultARN': 'arn:aws:glacier:us-east-1:999999999999:vaults/test-vault',
+ 'VaultName': 'test-vault'}
 """, o.getvalue()
 
 def test_lib():
@@ -214,6 +249,960 @@ def test_lib():
     #r = s.list_vaults()
     #assert v not in [x["VaultName"] for x in r["VaultList"]], r
 
+class StubSession:
+    def __init__(self, fail_after=None):
+        self.calls = []
+        self.fail_after = fail_after
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        if self.fail_after is not None and len(self.calls) >= self.fail_after:
+            raise libjokull.GlacierError(500, "ServiceUnavailableException", "stub failure", "Server")
+        self.calls.append((method, uri, headers, bytes(data) if data is not None else None))
+        class Response:
+            def info(self):
+                return dict(headers)
+        return Response()
+
+class PipeReader:
+    def __init__(self, data, chunk=100000):
+        self.f = io.BytesIO(data)
+        self.chunk = chunk
+    def readinto(self, b):
+        return self.f.readinto(memoryview(b)[:self.chunk])
+
+def test_multipart():
+    assert libjokull.part_size(0) == 4*1048576
+    assert libjokull.part_size(40000*1048576) == 4*1048576
+    assert libjokull.part_size(40000*1048576 + 1) == 8*1048576
+    assert libjokull.part_size(10 * 2**40) == 2048*1048576
+    try:
+        libjokull.part_size(50 * 2**40)
+        assert False
+    except ValueError:
+        pass
+    for args, stats in [(["jokull", "vaults", "--stats"], "table"), (["jokull", "--stats", "vaults"], "table"), (["jokull", "vaults", "--stats=json"], "json"), (["jokull", "vaults"], None)]:
+        assert jokull.option_flag(args, "--stats", "table") == stats and args == ["jokull", "vaults"], args
+    assert jokull.parse_size("1000") == 1000 and jokull.parse_size("1.5k") == 1536 and jokull.parse_size("2T") == 2 * 2**40
+
+    data = open("/dev/urandom", "rb").read(5*1048576 + 1000)
+    for workers, mode in [(1, "write"), (4, "write"), (1, "readinto"), (4, "readinto"), (1, "readahead"), (4, "readahead")]:
+        s = StubSession()
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload", workers=workers)
+        if mode == "readinto":
+            m.write_from(io.BytesIO(data))
+        elif mode == "readahead":
+            m.write_from(PipeReader(data), readahead=2)
+        else:
+            for i in range(0, len(data), 65536):
+                m.write(data[i:i+65536])
+        r = m.finish()
+        assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+        assert r["x-amz-archive-size"] == str(len(data)), r
+        parts = [x for x in s.calls if x[0] == "PUT"]
+        assert len(parts) == 6, parts
+        for method, uri, headers, part in parts:
+            start, end = map(int, re.match(r"bytes (\d+)-(\d+)/\*", dict(headers)["Content-Range"]).groups())
+            assert part == data[start:end+1], (start, end)
+        assert s.calls[-1][0] == "POST", s.calls[-1]
+
+    for n in [0, 1048576]:
+        s = StubSession()
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload")
+        m.write_from(PipeReader(data[:n]), readahead=2)
+        r = m.finish()
+        assert r["x-amz-archive-size"] == str(n) and len([x for x in s.calls if x[0] == "PUT"]) == n // 1048576, s.calls
+
+    for budget in [1048576, 4*1048576, 16*1048576]:
+        s = StubSession()
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload", workers=4, budget=budget)
+        m.write_from(PipeReader(data), readahead=2)
+        r = m.finish()
+        assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+        assert m.maxpending >= 4 and len(m.free) <= max(m.maxbuffers, budget // 1048576), (budget, m.maxpending, len(m.free))
+    for partsize in [libjokull.part_size(2 * 2**40), libjokull.part_size(5 * 2**40)]:
+        m = libjokull.Multipart(StubSession(), "test-vault", partsize, "test-upload", workers=4)
+        m.plan(libjokull.DEFAULT_READAHEAD)
+        assert m.maxpending == 4 and m.maxbuffers == 8, (partsize, m.maxpending, m.maxbuffers)
+    m = libjokull.Multipart(StubSession(), "test-vault", 32*1048576, "test-upload", workers=4)
+    m.plan(2)
+    assert m.maxpending == 8 and m.maxbuffers * 32*1048576 <= libjokull.DEFAULT_BUFFER_BUDGET, (m.maxpending, m.maxbuffers)
+
+    s = StubSession(fail_after=2)
+    m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload")
+    try:
+        m.write_from(PipeReader(data), readahead=2)
+        assert False, "expected GlacierError"
+    except libjokull.GlacierError:
+        pass
+
+    for write in [lambda m: m.write(data), lambda m: m.write_from(io.BytesIO(data)), lambda m: m.write_from(PipeReader(data), readahead=2)]:
+        s = StubSession(fail_after=0)
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload", workers=2)
+        try:
+            write(m)
+            assert False, "expected GlacierError"
+        except libjokull.GlacierError:
+            pass
+        try:
+            m.executor.submit(int)
+            assert False, "expected executor shutdown"
+        except RuntimeError:
+            pass
+
+    s = StubJokull()
+    s.set_response("upload_stream", {"x-amz-archive-id": "archive-new"})
+    stdin = sys.stdin
+    sys.stdin = io.TextIOWrapper(io.BytesIO(b"data"))
+    try:
+        o = io.StringIO()
+        jokull.do_upload(o, s, ["jokull", "upload", "test-vault", "--size", "3G", "--workers", "2", "--buffer", "1G"])
+    finally:
+        sys.stdin = stdin
+    assert s.calls[-1][0] == "upload_stream" and s.calls[-1][1][0] == "test-vault", s.calls[-1]
+    assert s.calls[-1][2] == {"size": 3 * 2**30, "partsize": None, "workers": 2, "budget": 2**30}, s.calls[-1]
+
+    server = fakeglacier.serve()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            s = libjokull.Jokull(access="test-access", secret="test-secret", host="127.0.0.1", port=server.server_address[1], secure=False)
+            s.dir = d
+            s.create_vault("test-vault")
+            r = s.upload_stream("test-vault", PipeReader(data), size=len(data), workers=2)
+            assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+            assert fakeglacier.FakeGlacierHandler.vaults["test-vault"][r["x-amz-archive-id"]] == data
+            s.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_resume():
+    data = open("/dev/urandom", "rb").read(5*1048576 + 1000)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "uploads", "test-upload")
+        journal = libjokull.Journal(path)
+        journal.start("upload", "test-vault", "test-upload", 1048576, "test-file", len(data))
+        s = StubSession(fail_after=3)
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload", journal=journal)
+        try:
+            m.write(data)
+            m.finish()
+            assert False, "expected failure"
+        except libjokull.GlacierError:
+            pass
+        journal = libjokull.Journal(path)
+        assert (journal.kind, journal.vault, journal.id, journal.partsize, journal.size) == ("upload", "test-vault", "test-upload", 1048576, len(data))
+        assert sorted(journal.parts) == [0, 1048576, 2*1048576], journal.parts
+
+        s = StubSession()
+        m = libjokull.Multipart(s, "test-vault", 1048576, "test-upload", workers=4, journal=journal)
+        m.write(data)
+        r = m.finish()
+        assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+        assert sorted(int(dict(x[2])["Content-Range"].split()[1].split("-")[0]) for x in s.calls if x[0] == "PUT") == [3*1048576, 4*1048576, 5*1048576]
+        assert not os.path.exists(path)
+
+        journal = libjokull.Journal(path)
+        journal.start("upload", "test-vault", "test-upload", 1048576, "test-file", len(data))
+        journal.add(0, 1048576, sha256tree.treehash(b"changed").hexdigest())
+        m = libjokull.Multipart(StubSession(), "test-vault", 1048576, "test-upload", journal=journal)
+        try:
+            m.write(data)
+            assert False, "expected ResumeError"
+        except libjokull.ResumeError:
+            pass
+
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "file")
+        with open(fn, "wb") as f:
+            f.write(data)
+        now = time.time()
+        for age, id in [(100, "old-upload"), (10, "expired-upload")]:
+            journal = libjokull.Journal(os.path.join(d, "uploads", id))
+            journal.start("upload", "test-vault", id, libjokull.part_size(len(data)), fn, len(data))
+            journal.f.close()
+            os.utime(journal.path, (now - age, now - age))
+        server = fakeglacier.serve()
+        try:
+            s = libjokull.Jokull(access="test-access", secret="test-secret", host="127.0.0.1", port=server.server_address[1], secure=False)
+            s.dir = d
+            s.create_vault("test-vault")
+            with open(fn, "rb") as f:
+                r = s.upload_archive("test-vault", f, filename=fn, resume=True)
+            assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+            assert sorted(os.listdir(os.path.join(d, "uploads"))) == ["old-upload"], os.listdir(os.path.join(d, "uploads"))
+            s.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+def test_pool():
+    class Connection:
+        def __init__(self):
+            self.closed = False
+        def close(self):
+            self.closed = True
+
+    p = libjokull.ConnectionPool("test-host", size=1)
+    p.connect = Connection
+    c1, reused = p.get()
+    assert not reused
+    p.put(c1)
+    c2, reused = p.get()
+    assert c2 is c1 and reused
+    c3, reused = p.get()
+    assert c3 is not c1 and not reused
+    p.put(c1)
+    p.put(c3)
+    assert c3.closed and not c1.closed
+    p.idle_timeout = 0
+    c4, reused = p.get()
+    assert c4 is not c1 and not reused
+    assert c1.closed
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    try:
+        s = libjokull.Jokull(access="test-access", secret="test-secret", max_retries=0, host="127.0.0.1", port=listener.getsockname()[1], secure=False, timeout=0.2)
+        start = time.monotonic()
+        try:
+            s.request("GET", "/-/vaults")
+            assert False, "expected TimeoutError"
+        except TimeoutError:
+            pass
+        assert time.monotonic() - start < 5
+        s.close()
+    finally:
+        listener.close()
+
+def test_retry():
+    class RetryJokull(libjokull.Jokull):
+        def __init__(self, failures):
+            libjokull.Jokull.__init__(self, access="test-access", secret="test-secret", max_retries=3)
+            self.retry_base = 0.001
+            self.failures = failures
+            self.sent = []
+            self.hashes = []
+        def send(self, method, uri, headers, data, hashes, stream, query=None, trace=None):
+            self.sent.append(headers)
+            self.hashes.append(hashes)
+            if self.failures:
+                raise self.failures.pop(0)
+            return "response"
+
+    s = RetryJokull([ConnectionResetError(), libjokull.GlacierError(400, "ThrottlingException", "slow down", "Client"), libjokull.GlacierError(500, "InternalFailure", "oops", "Server")])
+    headers = [("Content-Range", "bytes 0-0/*")]
+    treehash_sha256 = sha256tree.treehash_sha256
+    calls = []
+    sha256tree.treehash_sha256 = lambda data: calls.append(data) or treehash_sha256(data)
+    try:
+        assert s.request("PUT", "/-/vaults/test-vault/multipart-uploads/test-upload", headers=headers, data=b"x") == "response"
+    finally:
+        sha256tree.treehash_sha256 = treehash_sha256
+    assert calls == [b"x"] and len(s.hashes) == 4 and all(x is s.hashes[0] for x in s.hashes), calls
+    assert s.retry_count == 3 and s.backoff_time >= 0, (s.retry_count, s.backoff_time)
+    assert all(x == headers for x in s.sent) and headers == [("Content-Range", "bytes 0-0/*")], s.sent
+
+    s = RetryJokull([libjokull.GlacierError(404, "ResourceNotFoundException", "missing", "Client")])
+    try:
+        s.request("GET", "/-/vaults/missing")
+        assert False, "expected GlacierError"
+    except libjokull.GlacierError as x:
+        assert x.code == "ResourceNotFoundException"
+    assert s.retry_count == 0
+
+    s = RetryJokull([ConnectionResetError()] * 4)
+    try:
+        s.request("GET", "/-/vaults")
+        assert False, "expected ConnectionResetError"
+    except ConnectionResetError:
+        pass
+    assert s.retry_count == 3 and len(s.sent) == 4, s.retry_count
+
+    lost = ConnectionResetError()
+    lost.sent = True
+    refused = ConnectionRefusedError()
+    refused.sent = False
+    s = RetryJokull([refused, libjokull.GlacierError(400, "ThrottlingException", "slow down", "Client"), lost])
+    try:
+        s.request("POST", "/-/vaults/test-vault/archives", data=b"x")
+        assert False, "expected ConnectionResetError"
+    except ConnectionResetError:
+        pass
+    assert s.retry_count == 2, s.retry_count
+    s = RetryJokull([libjokull.GlacierError(400, "ThrottlingException", "slow down", "Client")])
+    try:
+        s.request("DELETE", "/-/vaults/test-vault/archives/a", retry_throttling=False)
+        assert False, "expected GlacierError"
+    except libjokull.GlacierError as x:
+        assert x.code == "ThrottlingException"
+    assert s.retry_count == 0, s.retry_count
+    s = RetryJokull([libjokull.make_error(502, "<html>Bad Gateway</html>")])
+    try:
+        s.request("POST", "/-/vaults/test-vault/jobs", data=b"{}")
+        assert False, "expected GlacierError"
+    except libjokull.GlacierError:
+        pass
+    assert s.retry_count == 0, s.retry_count
+
+    class Connection:
+        def __init__(self, stale):
+            self.stale = stale
+        def connect(self):
+            raise ConnectionRefusedError()
+        def request(self, method, uri, body=None, headers=None):
+            pass
+        def getresponse(self):
+            raise http.client.RemoteDisconnected("closed")
+        def close(self):
+            pass
+    class Pool:
+        def __init__(self):
+            self.conns = [(Connection(True), True), (Connection(False), False)]
+        def get(self):
+            return self.conns.pop(0)
+    s = libjokull.Jokull(access="test-access", secret="test-secret", max_retries=0)
+    for method, error in [("GET", ConnectionRefusedError), ("POST", http.client.RemoteDisconnected)]:
+        s.pool = Pool()
+        try:
+            s.request(method, "/-/vaults/test-vault/archives")
+            assert False, "expected " + error.__name__
+        except error:
+            pass
+
+    e = libjokull.make_error(503, "<html>Service Unavailable</html>")
+    assert (e.httpcode, e.code, e.type) == (503, "Service Unavailable", "Server"), e
+    assert libjokull.retryable(e)
+
+def test_pages():
+    class PageJokull(libjokull.Jokull):
+        def __init__(self):
+            self.markers = []
+        def list_vaults(self, marker=None, limit=None):
+            self.markers.append(marker)
+            n = int(marker or 0)
+            return {"VaultList": [{"VaultName": "vault-{}".format(x)} for x in range(n, n + 2)], "Marker": str(n + 2) if n < 4 else None}
+
+    for prefetch in [False, True]:
+        s = PageJokull()
+        r = [x["VaultName"] for x in s.iter_vaults(prefetch=prefetch)]
+        assert r == ["vault-{}".format(x) for x in range(6)], r
+        assert s.markers == [None, "2", "4"], s.markers
+    s = PageJokull()
+    it = s.iter_vaults()
+    assert next(it)["VaultName"] == "vault-0"
+    assert s.markers == [None], s.markers
+
+def test_watch():
+    class WatchJokull(libjokull.Jokull):
+        def __init__(self, dir):
+            self.dir = dir
+            self.polls = []
+            self.pages = [
+                [{"JobList": [], "Marker": None}],
+                [{"JobList": [{"JobId": "job-x", "Completed": True}, {"JobId": "job-b", "Completed": True, "StatusCode": "Succeeded"}], "Marker": "page-2"},
+                 {"JobList": [{"JobId": "job-c", "Completed": True, "StatusCode": "Failed"}], "Marker": None}],
+            ]
+            self.downloads = []
+        def describe_job(self, vault, jobid):
+            if jobid == "job-a":
+                return {"JobId": jobid, "Completed": True, "StatusCode": "Succeeded"}
+            return {"JobId": jobid, "Completed": False, "StatusCode": "InProgress"}
+        def list_jobs(self, vault, completed=None, marker=None, limit=None):
+            self.polls.append((completed, marker))
+            page = self.pages[0].pop(0)
+            if not self.pages[0]:
+                self.pages.pop(0)
+            return page
+        def download(self, vault, jobid, filename):
+            self.downloads.append((jobid, filename))
+
+    with tempfile.TemporaryDirectory() as d:
+        s = WatchJokull(d)
+        r = [x["JobId"] for x in s.watch_jobs("test-vault", ["job-a", "job-b", "job-c"], interval=0.001)]
+        assert r == ["job-a", "job-b", "job-c"], r
+        assert s.polls == [(True, None), (True, None), (True, "page-2")], s.polls
+
+        s = WatchJokull(d)
+        r = sorted((job["JobId"], filename, error) for job, filename, error in s.download_jobs("test-vault", ["job-a", "job-b", "job-c"], d, interval=0.001))
+        assert r == [("job-a", os.path.join(d, "job-a"), None), ("job-b", os.path.join(d, "job-b"), None), ("job-c", None, None)], r
+        assert sorted(s.downloads) == [("job-a", os.path.join(d, "job-a")), ("job-b", os.path.join(d, "job-b"))], s.downloads
+
+        class SlowWatchJokull(WatchJokull):
+            def watch_jobs(self, vault, jobids, interval=None, max_interval=None):
+                yield {"JobId": "job-a", "Completed": True, "StatusCode": "Succeeded"}
+                self.streamed = self.received.wait(5)
+                yield {"JobId": "job-c", "Completed": True, "StatusCode": "Failed"}
+            def download(self, vault, jobid, filename):
+                time.sleep(0.1)
+        s = SlowWatchJokull(d)
+        s.received = threading.Event()
+        r = []
+        for job, filename, error in s.download_jobs("test-vault", ["job-a", "job-c"], d):
+            r.append(job["JobId"])
+            s.received.set()
+        assert s.streamed and r == ["job-a", "job-c"], r
+
+        s = StubJokull()
+        s.set_response("download_jobs", iter([({"JobId": "job-a", "StatusCode": "Succeeded"}, "out/job-a", None), ({"JobId": "job-c", "StatusCode": "Failed", "StatusMessage": "failed"}, None, None)]))
+        o = io.StringIO()
+        jokull.do_watch(o, s, ["jokull", "watch", "test-vault", "job-a", "job-c", "--download", "out", "--interval", "5"])
+        assert s.calls[-1] == ("download_jobs", ("test-vault", ["job-a", "job-c"], "out"), {"interval": 5.0}), s.calls[-1]
+        assert o.getvalue() == "job-a\tSucceeded\tout/job-a\njob-c\tFailed\tfailed\n", o.getvalue()
+
+def test_download():
+    class DownloadJokull(libjokull.Jokull):
+        def __init__(self, data, dir):
+            self.data = data
+            self.dir = dir
+            self.ranges = []
+            self.fail = set()
+        def describe_job(self, vault, jobid):
+            return {
+                "Action": "ArchiveRetrieval",
+                "ArchiveSizeInBytes": len(self.data),
+                "SHA256TreeHash": sha256tree.treehash_simple(self.data).hexdigest(),
+            }
+        def get(self, vault, jobid, range=None):
+            self.ranges.append(range)
+            if range[0] in self.fail:
+                raise libjokull.GlacierError(500, "ServiceUnavailableException", "stub failure", "Server")
+            data = self.data[range[0]:range[1]+1]
+            r = io.BytesIO(data)
+            r.info = lambda: {"x-amz-sha256-tree-hash": sha256tree.treehash_simple(data).hexdigest()}
+            return r
+
+    data = open("/dev/urandom", "rb").read(5*1048576 + 1000)
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "output")
+        s = DownloadJokull(data, d)
+        s.fail = {2*1048576}
+        try:
+            s.download("test-vault", "test-jobid", fn, chunksize=1048576, workers=2)
+            assert False, "expected failure"
+        except libjokull.GlacierError:
+            pass
+        done = libjokull.Journal(os.path.join(d, "downloads", "test-jobid")).parts
+        assert 0 in done and 2*1048576 not in done, done
+        s.fail = set()
+        s.ranges = []
+        s.download("test-vault", "test-jobid", fn, chunksize=1048576, workers=2)
+        assert sorted(x[0] for x in s.ranges) == [x for x in range(0, len(data), 1048576) if x not in done], s.ranges
+        assert open(fn, "rb").read() == data
+        assert not os.path.exists(os.path.join(d, "downloads", "test-jobid"))
+
+    assert libjokull.chunk_size(1) == 1048576 and libjokull.chunk_size(3*1048576) == 2*1048576 and libjokull.chunk_size(32*1048576) == 32*1048576
+    data = open("/dev/urandom", "rb").read(7*1048576)
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "output")
+        s = DownloadJokull(data, d)
+        s.download("test-vault", "test-jobid", fn, chunksize=3*1048576, workers=2)
+        assert sorted(x[0] for x in s.ranges) == [0, 2*1048576, 4*1048576, 6*1048576], s.ranges
+        assert open(fn, "rb").read() == data
+
+def test_inventory():
+    with tempfile.TemporaryDirectory() as d:
+        log = os.path.join(d, "log")
+        with open(log, "w", newline="") as f:
+            w = csv.writer(f, lineterminator="\n")
+            w.writerow((1347958800.0, "create_vault", "test-vault"))
+            w.writerow((1347958801.0, "upload_archive", "test-vault", "a.tar", "archive-a", "hash-a"))
+            w.writerow((1347958802.0, "upload_archive", "test-vault", "b.tar", "archive-b", "hash-b"))
+            w.writerow((1347958803.0, "delete_archive", "test-vault", "archive-a"))
+        inv = inventory.Inventory(os.path.join(d, "inventory.db"))
+        inv.sync_log(log)
+        assert [x["archive_id"] for x in inv.find(vault="test-vault")] == ["archive-b"]
+        assert [x["archive_id"] for x in inv.find(vault="test-vault", deleted=True)] == ["archive-a", "archive-b"]
+        with open(log, "a", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerow((1347958804.0, "upload_archive", "test-vault", "c.tar", "archive-c", "hash-c"))
+        inv.sync_log(log)
+        assert [x["archive_id"] for x in inv.find(vault="test-vault")] == ["archive-b", "archive-c"]
+
+        doc = {
+            "VaultARN": "arn:aws:glacier:us-east-1:999999999999:vaults/test-vault",
+            "InventoryDate": "2012-09-18T09:00:03Z",
+            "ArchiveList": [
+                {"ArchiveId": "archive-c", "ArchiveDescription": "c.tar", "CreationDate": "2012-09-18T09:00:04Z", "Size": 3, "SHA256TreeHash": "hash-c"},
+                {"ArchiveId": "archive-d", "ArchiveDescription": "d.tar", "CreationDate": "2012-09-17T00:00:00Z", "Size": 4, "SHA256TreeHash": "hash-d"},
+            ],
+        }
+        inv.load_inventory("test-vault", io.BytesIO(json.dumps(doc).encode("UTF-8")))
+        assert [x["archive_id"] for x in inv.find(vault="test-vault")] == ["archive-d", "archive-c"]
+        assert inv.find(tree_hash="hash-c")[0]["size"] == 3
+        assert [x["archive_id"] for x in inv.find(pattern="d.*")] == ["archive-d"]
+        assert [x["archive_id"] for x in inv.find(pattern="hash-c")] == ["archive-c"]
+
+        s = StubJokull()
+        s.set_response("inventory", inv)
+        o = io.StringIO()
+        jokull.do_ls(o, s, ["jokull", "ls", "test-vault"])
+        assert o.getvalue() == """test-vault\t2012-09-17T00:00:00Z\t4\tarchive-d\thash-d\td.tar
+test-vault\t2012-09-18T09:00:04Z\t3\tarchive-c\thash-c\tc.tar
+""", o.getvalue()
+        o = io.StringIO()
+        jokull.do_find(o, s, ["jokull", "find", "c.*"])
+        assert o.getvalue() == "test-vault\t2012-09-18T09:00:04Z\t3\tarchive-c\thash-c\tc.tar\n", o.getvalue()
+        inv.close()
+
+def test_inventory_reader():
+    doc = {
+        "VaultARN": "arn:aws:glacier:us-east-1:999999999999:vaults/test-vault",
+        "InventoryDate": "2012-09-18T09:00:03Z",
+        "ArchiveList": [
+            {"ArchiveId": "archive-{}".format(i), "ArchiveDescription": "f\u00e9{}.tar".format(i), "CreationDate": "2012-09-{:02}T00:00:00Z".format(i + 1), "Size": i, "SHA256TreeHash": "hash-{}".format(i)}
+            for i in range(20)
+        ],
+    }
+    data = json.dumps(doc, indent=1).encode("UTF-8")
+    for chunksize in (1, 7, 65536):
+        r = inventory.InventoryReader(io.BytesIO(data), chunksize=chunksize)
+        assert list(r) == doc["ArchiveList"]
+        assert r.inventory_date == "2012-09-18T09:00:03Z"
+        assert r.vault_arn == doc["VaultARN"]
+    r = inventory.InventoryReader(io.BytesIO(data), since="2012-09-06", until="2012-09-09", description="f\u00e9[3-8].tar", chunksize=5)
+    assert [x["ArchiveId"] for x in r] == ["archive-5", "archive-6", "archive-7"]
+    try:
+        list(inventory.InventoryReader(io.BytesIO(data[:len(data) // 2]), chunksize=16))
+        assert False
+    except ValueError:
+        pass
+
+    text = 'ArchiveId,ArchiveDescription,CreationDate,Size,SHA256TreeHash\r\narchive-a,"a, ""quoted""\nname",2012-09-17T00:00:00Z,4,hash-a\r\narchive-b,b.tar,2012-09-18T00:00:00Z,5,hash-b\r\n'
+    for chunksize in (3, 65536):
+        r = inventory.InventoryReader(io.BytesIO(text.encode("UTF-8")), chunksize=chunksize)
+        assert list(r) == [
+            {"ArchiveId": "archive-a", "ArchiveDescription": 'a, "quoted"\nname', "CreationDate": "2012-09-17T00:00:00Z", "Size": 4, "SHA256TreeHash": "hash-a"},
+            {"ArchiveId": "archive-b", "ArchiveDescription": "b.tar", "CreationDate": "2012-09-18T00:00:00Z", "Size": 5, "SHA256TreeHash": "hash-b"},
+        ]
+        assert r.inventory_date is None
+
+def write_log(path, name, count):
+    log = oplog.Log(path, durability="op", max_size=4096)
+    for i in range(count):
+        log.write("upload_archive", "vault-{}".format(i % 3), "{}-{}".format(name, i), "archive-{}-{}".format(name, i), "hash")
+    log.close()
+
+def test_oplog():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "log")
+        mark_interval = oplog.MARK_INTERVAL
+        oplog.MARK_INTERVAL = 4
+        try:
+            write_log(path, "a", 200)
+        finally:
+            oplog.MARK_INTERVAL = mark_interval
+        files = oplog.segments(path)
+        assert len(files) > 3 and files[-1] == (len(files), path), files
+        for number, filename in files[:-1]:
+            index = oplog.read_index(filename)
+            assert index["rows"] > 0 and index["start"] <= index["end"] and index["vaults"] == ["vault-0", "vault-1", "vault-2"], index
+            assert index["marks"] and all(a[0] < b[0] for a, b in zip(index["marks"], index["marks"][1:])), index
+
+        reader = oplog.LogReader(path)
+        rows = list(reader.read())
+        assert [x[3] for x in rows] == ["a-{}".format(i) for i in range(200)]
+        assert [x[3] for x in reader.read(vault="vault-1")] == ["a-{}".format(i) for i in range(1, 200, 3)]
+        middle = float(rows[120][0])
+        assert list(reader.read(since=middle)) == [x for x in rows if float(x[0]) >= middle]
+        assert list(reader.read(until=middle)) == [x for x in rows if float(x[0]) < middle]
+        assert list(reader.read(since=float(rows[-1][0]) + 1)) == []
+        assert [x[2] for x in reader.read_from(*[(s, o) for s, o, x in reader.read_from() if x[3] == "a-149"][0])] == rows[150:]
+
+        s = StubJokull()
+        s.dir = d
+        s.oplog = None
+        o = io.StringIO()
+        jokull.do_log(o, s, ["jokull", "log", "--vault", "vault-2", "--since", rows[100][0]])
+        assert list(csv.reader(io.StringIO(o.getvalue()))) == [x for x in rows[100:] if x[2] == "vault-2"]
+        assert jokull.parse_time("2012-09-18T09:00:03Z") == 1347958803 and jokull.parse_time("1347958803.5") == 1347958803.5
+
+        inv = inventory.Inventory(os.path.join(d, "inventory.db"))
+        inv.sync_log(path)
+        assert len(inv.find()) == 200
+        write_log(path, "b", 100)
+        inv.sync_log(path)
+        assert len(inv.find()) == 300
+        inv.close()
+
+        log = oplog.Log(path, durability="periodic", interval=0.05)
+        size = os.path.getsize(path)
+        log.write("create_vault", "vault-x")
+        assert os.path.getsize(path) == size
+        deadline = time.time() + 5
+        while os.path.getsize(path) == size and time.time() < deadline:
+            time.sleep(0.01)
+        assert list(reader.read(vault="vault-x"))[0][1] == "create_vault"
+        log.write("delete_vault", "vault-x")
+        log.close()
+        assert [x[1] for x in reader.read(vault="vault-x")] == ["create_vault", "delete_vault"]
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "log")
+        procs = [multiprocessing.Process(target=write_log, args=(path, name, 150)) for name in "abcd"]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert p.exitcode == 0
+        rows = list(oplog.LogReader(path).read())
+        assert sorted(x[3] for x in rows) == sorted("{}-{}".format(n, i) for n in "abcd" for i in range(150)), len(rows)
+        for number, filename in oplog.segments(path)[:-1]:
+            assert oplog.read_index(filename)["rows"] == len(list(oplog.read_rows(filename)))
+
+class RequestJokull(libjokull.Jokull):
+    def __init__(self, dir):
+        self.dir = dir
+        self.requests = []
+        self.hash_cache = None
+        self.hash_cache_path = None
+        self.oplog = None
+        self.log_durability = "op"
+        self.lock = threading.Lock()
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        self.requests.append((method, uri))
+        tree_hash = dict(headers or []).get("x-amz-sha256-tree-hash") or sha256tree.treehash(data or b"").hexdigest()
+        class Response:
+            def info(self):
+                return {"x-amz-archive-id": "archive-new", "x-amz-multipart-upload-id": "upload-new", "x-amz-sha256-tree-hash": tree_hash}
+        return Response()
+
+def test_dedup():
+    with tempfile.TemporaryDirectory() as d:
+        s = RequestJokull(d)
+        with open(os.path.join(d, "log"), "w", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerow((1347958801.0, "upload_archive", "test-vault", "a", "archive-a", sha256tree.treehash(b"data").hexdigest()))
+        r = s.upload_archive("test-vault", io.BytesIO(b"data"), filename="b", dedup=True)
+        assert r["x-amz-archive-id"] == "archive-a", r
+        assert s.requests == [], s.requests
+        r = s.upload_archive("other-vault", io.BytesIO(b"data"), filename="b", dedup=True)
+        assert r["x-amz-archive-id"] == "archive-new", r
+        assert s.requests == [("POST", "/-/vaults/other-vault/archives")], s.requests
+        r = s.upload_archive("test-vault", b"other data", filename="c", dedup=True)
+        assert r["x-amz-archive-id"] == "archive-new", r
+
+def test_delete_archives():
+    class DeleteJokull(RequestJokull):
+        def __init__(self, dir):
+            RequestJokull.__init__(self, dir)
+            self.pool = libjokull.ConnectionPool("test-host")
+            self.deleted = []
+            self.throttle_count = 3
+            self.lock = threading.Lock()
+        def delete_archive(self, vault, archive, retry_throttling=True):
+            assert not retry_throttling
+            with self.lock:
+                if self.throttle_count > 0:
+                    self.throttle_count -= 1
+                    raise libjokull.GlacierError(400, "ThrottlingException", "slow down", "Client")
+                if archive == "gone":
+                    raise libjokull.GlacierError(404, "ResourceNotFoundException", "gone", "Client")
+                if archive == "bad":
+                    raise libjokull.GlacierError(403, "AccessDeniedException", "denied", "Client")
+                if archive == "reset":
+                    raise ConnectionResetError("reset")
+                self.deleted.append(archive)
+            return True
+
+    with tempfile.TemporaryDirectory() as d:
+        s = DeleteJokull(d)
+        archives = ["archive-{}".format(x) for x in range(50)] + ["gone", "bad", "reset", ""]
+        r = list(s.delete_archives("test-vault", [x + "\n" for x in archives], workers=4))
+        assert sorted(x[0] for x in r if x[1]) == sorted(archives[:51]), r
+        assert sorted((x[0], type(x[2]).__name__) for x in r if x[2] is not None) == [("bad", "GlacierError"), ("reset", "ConnectionResetError")], r
+        assert sorted(s.deleted) == sorted(archives[:50]), s.deleted
+        s.deleted = []
+        r = list(s.delete_archives("test-vault", archives, workers=4))
+        assert sorted(x[0] for x in r if not x[1] and x[2] is None) == sorted(archives[:51]), r
+        assert sorted(x[0] for x in r if x[2] is not None) == ["bad", "reset"], r
+        assert s.deleted == [], s.deleted
+
+        s = StubJokull()
+        s.set_response("delete_archives", iter([("a", True, None), ("b", False, None), ("c", False, libjokull.GlacierError(403, "AccessDeniedException", "denied", "Client"))]))
+        ids = os.path.join(d, "ids")
+        with open(ids, "w") as f:
+            f.write("a\nb\nc\n")
+        o = io.StringIO()
+        jokull.do_delete_many(o, s, ["jokull", "delete-many", "test-vault", ids, "--workers", "8"])
+        assert s.calls[-1][0] == "delete_archives" and s.calls[-1][1][0] == "test-vault", s.calls[-1]
+        assert s.calls[-1][2] == {"workers": 8, "checkpoint": None}, s.calls[-1]
+        assert o.getvalue() == 'error\tc\tGlacierError(httpcode=403 code=AccessDeniedException message="denied" type=Client)\n1 deleted, 1 skipped, 1 failed\n', o.getvalue()
+
+def test_upload_tree():
+    with tempfile.TemporaryDirectory() as d:
+        tree = os.path.join(d, "tree")
+        os.makedirs(os.path.join(tree, "sub"))
+        files = {"a": b"a", "b": b"bb", os.path.join("sub", "c"): b"ccc", "large": open("/dev/urandom", "rb").read(5*1048576)}
+        for name, data in files.items():
+            with open(os.path.join(tree, name), "wb") as f:
+                f.write(data)
+        s = RequestJokull(d)
+        results = list(s.upload_tree("test-vault", tree, workers=2))
+        assert sorted((os.path.relpath(x[0], tree), x[1]) for x in results) == sorted((k, len(v)) for k, v in files.items()), results
+        assert all(x[3] is None and x[2]["x-amz-archive-id"] == "archive-new" for x in results), results
+        assert len([x for x in s.requests if x == ("POST", "/-/vaults/test-vault/archives")]) == 3, s.requests
+        assert len([x for x in s.requests if x[0] == "PUT"]) == 2, s.requests
+
+        s = StubJokull()
+        s.set_response("upload_tree", iter([("a", 1, {"x-amz-archive-id": "archive-a"}, None), ("b", None, None, OSError("failed"))]))
+        o = io.StringIO()
+        jokull.do_upload_tree(o, s, ["jokull", "upload-tree", "test-vault", tree, "--workers", "3", "--max-rate", "1000"])
+        assert s.calls[-2] == ("set_limits", (), {"max_requests": None, "max_rate": 1000}), s.calls[-2]
+        assert s.calls[-1] == ("upload_tree", ("test-vault", tree), {"workers": 3, "dedup": False}), s.calls[-1]
+        assert o.getvalue() == "ok\ta\tarchive-a\nerror\tb\tfailed\n1 uploaded, 1 failed, 1 bytes\n", o.getvalue()
+
+def test_async():
+    async def run(s):
+        await s.create_vault("test-vault")
+        r = await s.list_vaults()
+        assert r["VaultList"] == [{"VaultName": "test-vault"}], r
+        r = await asyncio.gather(*[s.describe_vault("test-vault") for x in range(20)])
+        assert all(x["VaultName"] == "test-vault" for x in r), r
+        r = await s.upload_archive("test-vault", b"data")
+        assert r["x-amz-archive-id"] == "archive-0", r
+        data = open("/dev/urandom", "rb").read(5*1048576 + 1000)
+        m = await s.upload_multipart("test-vault", partsize=1048576, workers=3)
+        for i in range(0, len(data), 65536):
+            await m.write(data[i:i+65536])
+        r = await m.finish()
+        a = r["x-amz-archive-id"]
+        assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest(), r
+        r = await s.get("test-vault", a)
+        got = b""
+        while True:
+            chunk = await r.read(65536)
+            if not chunk:
+                break
+            got += chunk
+        assert got == data
+        assert await s.delete_archive("test-vault", a)
+        try:
+            await s.describe_job("missing-vault", "missing-job")
+            assert False, "expected GlacierError"
+        except libjokull.GlacierError as x:
+            assert x.httpcode == 404, x
+        await s.close()
+
+    server = fakeglacier.serve()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            s = libjokull.AsyncJokull(concurrency=8, access="test-access", secret="test-secret", host="127.0.0.1", port=server.server_address[1], secure=False)
+            s.dir = d
+            asyncio.run(run(s))
+    finally:
+        server.shutdown()
+
+def test_metrics():
+    assert libjokull.operation_name("GET", "/-/vaults?limit=10") == "ListVaults"
+    assert libjokull.operation_name("PUT", "/-/vaults/v/multipart-uploads/u") == "UploadMultipartPart"
+    assert libjokull.operation_name("GET", "/-/vaults/v/jobs/j/output") == "GetJobOutput"
+    assert libjokull.operation_name("PATCH", "/-/vaults/v") == "PATCH /vaults/*"
+
+    server = fakeglacier.serve()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            traces = []
+            s = libjokull.Jokull(access="test-access", secret="test-secret", host="127.0.0.1", port=server.server_address[1], secure=False)
+            s.dir = d
+            s.metrics.add_hook(traces.append)
+            s.create_vault("test-vault")
+            a = s.upload_archive("test-vault", b"data")["x-amz-archive-id"]
+            m = s.upload_multipart("test-vault", partsize=1048576, workers=2)
+            m.write(b"x" * (2*1048576 + 10))
+            m.finish()
+            r = s.get("test-vault", a, range=(0, 1))
+            assert r.read() == b"da"
+            try:
+                s.describe_vault("missing-vault")
+                assert False, "expected GlacierError"
+            except libjokull.GlacierError:
+                pass
+            s.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    summary = s.metrics.summary()
+    ops = summary["operations"]
+    assert sorted(ops) == ["CompleteMultipartUpload", "CreateVault", "DescribeVault", "GetJobOutput", "InitiateMultipartUpload", "UploadArchive", "UploadMultipartPart"], sorted(ops)
+    assert ops["UploadMultipartPart"]["count"] == 3 and ops["UploadMultipartPart"]["sent"] == 2*1048576 + 10, ops["UploadMultipartPart"]
+    assert ops["UploadMultipartPart"]["phases"]["hash"] > 0
+    assert ops["UploadArchive"]["sent"] == 4 and ops["UploadArchive"]["status"] == {"201": 1}, ops["UploadArchive"]
+    assert ops["GetJobOutput"]["received"] == 2 and "receive" in ops["GetJobOutput"]["phases"], ops["GetJobOutput"]
+    assert ops["DescribeVault"]["errors"] == 1 and ops["DescribeVault"]["status"] == {"404": 1}, ops["DescribeVault"]
+    assert summary["total"]["count"] == len(traces) == 9, summary["total"]
+    assert all(t.elapsed >= sum(t.phases.values()) - 1e-6 for t in traces if t.operation != "UploadMultipartPart")
+
+    o = io.StringIO()
+    jokull.print_stats(o, s.metrics, "json")
+    assert json.loads(o.getvalue()) == json.loads(json.dumps(summary))
+    o = io.StringIO()
+    jokull.print_stats(o, s.metrics)
+    lines = o.getvalue().splitlines()
+    assert lines[0].split()[:3] == ["operation", "count", "errors"] and lines[-1].split()[:2] == ["total", "9"], lines
+
+def test_hash_cache():
+    with tempfile.TemporaryDirectory() as d:
+        cache = sha256tree.HashCache(os.path.join(d, "treehash.db"), leaves=True)
+        path = os.path.join(d, "file")
+        data = open("/dev/urandom", "rb").read(6*1048576 + 5)
+        with open(path, "wb") as f:
+            f.write(data)
+        past = time.time_ns() - 10 * 10**9
+        os.utime(path, ns=(past, past))
+        with open(path, "rb") as f:
+            assert sha256tree.hash_file(f, cache=cache).digest() == sha256tree.treehash_simple(data).digest()
+            tree_hash, leaves = cache.get(os.fstat(f.fileno()))
+            assert len(leaves) == 7 * 32 and sha256tree.reduce_leaves(leaves).digest() == tree_hash
+            leaves_parallel = sha256tree.leaves_parallel
+            sha256tree.leaves_parallel = None
+            try:
+                assert sha256tree.hash_file(f, cache=cache).digest() == tree_hash
+            finally:
+                sha256tree.leaves_parallel = leaves_parallel
+
+        with open(path, "r+b") as f:
+            f.write(b"changed")
+        os.utime(path, ns=(past + 10**9, past + 10**9))
+        data = b"changed" + data[7:]
+        with open(path, "rb") as f:
+            assert sha256tree.hash_file(f, cache=cache).digest() == sha256tree.treehash_simple(data).digest()
+
+        time.sleep(0.01)
+        with open(path, "r+b") as f:
+            f.write(b"CHANGED")
+        os.utime(path, ns=(past + 10**9, past + 10**9))
+        data = b"CHANGED" + data[7:]
+        with open(path, "rb") as f:
+            assert sha256tree.hash_file(f, cache=cache).digest() == sha256tree.treehash_simple(data).digest()
+
+        os.utime(path)
+        with open(path, "rb") as f:
+            sha256tree.hash_file(f, cache=cache)
+            assert cache.get(os.fstat(f.fileno())) is None
+
+        class Stat:
+            def __init__(self, ino):
+                self.st_dev, self.st_ino, self.st_size, self.st_mtime_ns, self.st_ctime_ns = 1, ino, 0, 0, 0
+        small = sha256tree.HashCache(os.path.join(d, "small.db"), max_size=400)
+        for i in range(5):
+            small.put(Stat(i), bytes(32))
+        assert [small.get(Stat(i)) is not None for i in range(5)] == [False, False, True, True, True]
+        small.get(Stat(2))
+        small.put(Stat(5), bytes(32))
+        assert [small.get(Stat(i)) is not None for i in range(2, 6)] == [True, False, True, True]
+        small.close()
+        small = sha256tree.HashCache(os.path.join(d, "small.db"), max_size=400)
+        total = small.db.execute("select value from meta where key = 'total'").fetchone()[0]
+        assert total == small.db.execute("select sum(cost) from hashes").fetchone()[0] == 3 * 132, total
+        small.close()
+
+        os.utime(path, ns=(past, past))
+        server = fakeglacier.serve()
+        try:
+            s = libjokull.Jokull(access="test-access", secret="test-secret", host="127.0.0.1", port=server.server_address[1], secure=False, hash_cache=cache)
+            s.dir = d
+            s.create_vault("test-vault")
+            with open(path, "rb") as f:
+                r = s.upload_archive("test-vault", f, dedup=True)
+                assert r["x-amz-sha256-tree-hash"] == sha256tree.treehash_simple(data).hexdigest()
+                r = s.upload_archive("test-vault", f, dedup=True)
+                assert r["x-amz-archive-id"] == "archive-0", r
+            small = os.path.join(d, "small")
+            with open(small, "wb") as f:
+                f.write(b"data")
+            os.utime(small, ns=(past, past))
+            with open(small, "rb") as f:
+                s.upload_archive("test-vault", f)
+                assert cache.get(os.fstat(f.fileno()))[0] == sha256tree.treehash(b"data").digest()
+            s.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        cache.close()
+
+def test_batch():
+    assert jokull.parse_batch_line('describe "my vault"\n') == (None, ["describe", "my vault"])
+    assert jokull.parse_batch_line('["delete", "v", "a"]') == (None, ["delete", "v", "a"])
+    assert jokull.parse_batch_line('{"id": 7, "args": ["create", "v"]}') == (7, ["create", "v"])
+
+    class Pool:
+        size = 2
+    s = StubJokull()
+    s.pool = Pool()
+    s.set_response("describe_vault", {"VaultName": "v1"})
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("""# setup
+create v1
+wait
+["describe", "v1"]
+{"id": "d", "args": ["delete", "v1", "archive-1"]}
+create "unterminated
+frobnicate v1
+upload v1
+upload v1 --size 1G
+delete-many v1 -
+
+""")
+    try:
+        o = io.StringIO()
+        jokull.do_batch(o, s, ["jokull", "batch", f.name, "--workers", "3"])
+    finally:
+        os.unlink(f.name)
+    assert s.pool.size == 3
+    results = [json.loads(x) for x in o.getvalue().splitlines()]
+    assert results[0] == {"line": 2, "command": ["create", "v1"], "ok": True, "output": ""}, results[0]
+    results = {x["line"]: x for x in results}
+    assert sorted(results) == [2, 4, 5, 6, 7, 8, 9, 10], sorted(results)
+    assert results[4]["ok"] and results[4]["output"] == "{'VaultName': 'v1'}\n", results[4]
+    assert results[5]["ok"] and results[5]["id"] == "d", results[5]
+    assert not any(results[x]["ok"] for x in [6, 7, 8, 9, 10]), results
+    assert ("create_vault", ("v1",)) in s.calls and ("delete_archive", ("v1", "archive-1")) in s.calls, s.calls
+    assert not any(x[0] in ("upload_stream", "delete_archives") for x in s.calls), s.calls
+
+    class Output(io.StringIO):
+        printed = threading.Event()
+        def write(self, s):
+            if '"fast"' in s:
+                self.printed.set()
+            return super().write(s)
+    streamed = []
+    def lines():
+        yield "create fast\n"
+        streamed.append(Output.printed.wait(5))
+        yield "create slow\n"
+    stdin = sys.stdin
+    sys.stdin = lines()
+    try:
+        o = Output()
+        jokull.do_batch(o, s, ["jokull", "batch", "--workers", "2"])
+    finally:
+        sys.stdin = stdin
+    assert streamed == [True], o.getvalue()
+    assert [json.loads(x)["line"] for x in o.getvalue().splitlines()] == [1, 2], o.getvalue()
+
+    class OrderJokull(StubJokull):
+        def create_vault(self, name):
+            time.sleep(0.1)
+            self.calls.append(("create_vault", (name,)))
+    s = OrderJokull()
+    s.pool = Pool()
+    stdin = sys.stdin
+    sys.stdin = io.StringIO("create v1\ndelete v1 a\ndelete v2 b\n")
+    try:
+        o = io.StringIO()
+        jokull.do_batch(o, s, ["jokull", "batch", "--workers", "4"])
+    finally:
+        sys.stdin = stdin
+    assert s.calls == [("delete_archive", ("v2", "b")), ("create_vault", ("v1",)), ("delete_archive", ("v1", "a"))], s.calls
+    assert [json.loads(x)["line"] for x in o.getvalue().splitlines()] == [3, 1, 2], o.getvalue()
+
+def test_benchmark():
+    results = benchmark.run(2*1048576 + 1000, repeat=1, workers=2)
+    assert [x["name"] for x in results] == [x[0] for x in benchmark.Benchmarks], results
+    assert all(x["mb_per_s"] > 0 for x in results if x["name"] != "sign"), results
+    assert [x for x in results if x["name"] == "sign"][0]["ops"] == 10000, results
+    benchmark.compare(results, {"results": [{"name": "get", "mb_per_s": results[-1]["mb_per_s"] / 2}]})
+    assert abs(results[-1]["change"] - 1) < 1e-9, results[-1]
+
 def test_treehash():
     for x in [0, 1, 1000, 1048575, 1048576, 1048577, 6815744, 10485760, 9999999]:
         data = open("/dev/urandom", "rb").read(x)
@@ -221,6 +1210,9 @@ def test_treehash():
         sh = sha256tree.treehash_simple(data).digest()
         fh = sha256tree.treehash(data).digest()
         assert fh == sh, x
+        lh, fh = sha256tree.treehash_sha256(data)
+        assert lh.digest() == hashlib.sha256(data).digest(), x
+        assert fh.digest() == sh, x
         th = sha256tree.TreeHash()
         while data:
             part = data[:random.randrange(2*1048576+1)]
@@ -229,8 +1221,69 @@ def test_treehash():
         ph = th.finish().digest()
         assert ph == sh, x
 
+    data = open("/dev/urandom", "rb").read(7*1048576 + 5)
+    sh = sha256tree.treehash_simple(data).digest()
+    th = sha256tree.TreeHash()
+    assert th.update_from(io.BytesIO(data)) == len(data)
+    assert th.digest() == sh and th.size() == len(data)
+    th = sha256tree.TreeHash()
+    th.update(memoryview(data)[:3*1048576])
+    snap = th.copy()
+    th.update(data[3*1048576:])
+    assert th.digest() == sh
+    assert snap.digest() == sha256tree.treehash_simple(data[:3*1048576]).digest()
+    segments = []
+    for x in range(0, len(data), 2*1048576):
+        h = sha256tree.TreeHash()
+        h.update(data[x:x+2*1048576])
+        segments.append(h)
+    th = sha256tree.TreeHash()
+    for h in segments:
+        th.merge(h)
+    assert th.digest() == sh
+    for a, b in [(1048576, 3*1048576), (3*1048576, 5*1048576), (100, 1048576)]:
+        th = sha256tree.TreeHash()
+        th.update(data[:a])
+        h = sha256tree.TreeHash()
+        h.update(data[a:b])
+        try:
+            th.merge(h)
+            assert False, (a, b)
+        except ValueError:
+            pass
+
+    with tempfile.NamedTemporaryFile() as f:
+        for x in [0, 1, 1048576, 6815744, 70*1048576 + 1]:
+            data = open("/dev/urandom", "rb").read(x)
+            f.seek(0)
+            f.truncate()
+            f.write(data)
+            f.flush()
+            sh = sha256tree.treehash_simple(data).digest()
+            assert sha256tree.hash_file(f).digest() == sh, x
+            assert sha256tree.hash_file(f, workers=3).digest() == sh, x
+            assert sha256tree.hash_file(f, workers=2, processes=True).digest() == sh, x
+
 if __name__ == "__main__":
     test_signatures()
     test_cmdline()
     test_lib()
+    test_multipart()
+    test_resume()
+    test_pool()
+    test_retry()
+    test_pages()
+    test_watch()
+    test_download()
+    test_inventory()
+    test_inventory_reader()
+    test_oplog()
+    test_dedup()
+    test_delete_archives()
+    test_upload_tree()
+    test_async()
+    test_metrics()
+    test_hash_cache()
+    test_batch()
+    test_benchmark()
     test_treehash()